@@ -4,218 +4,1454 @@ Anvilord is a tool for lossless Minecraft world compression.
 
 import os
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import cProfile
+import itertools
+import multiprocessing
+import pstats
+import random
+import sys
 import time
 import datetime
+import functools
 import gzip
+import io
 import json
+import re
+import shutil
+import struct
+import tempfile
 import zipfile
+import zlib
 
 import zopfli
 
 from __version__ import __version__
+from cache import RecompressionCache
+from metrics import Metrics
+import archive
+import checkpoint
+import chunk
+import estimate
+import rawdeflate
 import region
+import solid
+import timebudget
+import worlddir
+import worldindex
 
-def search_for_region_folders(path):
-    contents = os.listdir(path)
-    regions = []
-
-    for i, j in enumerate(contents):
-        temp_path = path + "/" + j
-        if os.path.isdir(temp_path):
-            if (temp_path.endswith("region")
-                or temp_path.endswith("entities")
-                or temp_path.endswith("poi")):
-                regions.append(temp_path)
+compression_scheme_mappings = {"gzip": 1, "zlib": 2, "uncompressed": 3, "lz4": 4}
+
+# Non-region files are streamed in blocks of this size.
+BLOCK_SIZE = 1024 ** 2
+
+# Recompressed GZip data bigger than this is spooled to disk.
+SPOOL_SIZE = 16 * 1024 ** 2
+
+# Chunk compression schemes, which Deflate can still shrink.
+COMPRESSIBLE_CHUNK_TYPES = (3, 4)
+
+# Regions, which data is mostly in compressible chunks, are compressed as a
+# whole in adaptive output mode.
+MAX_COMPRESSIBLE_SHARE = 0.5
+
+# Files are sampled for adaptive output. Files which compress worse than
+# STORE_RATIO are stored, worse than FAST_DEFLATE_RATIO get level 1.
+SAMPLE_SIZE = 64 * 1024
+STORE_RATIO = 0.95
+FAST_DEFLATE_RATIO = 0.8
+
+# Region file names carry region coordinates.
+REGION_NAME = re.compile(r"r\.(-?\d+)\.(-?\d+)\.mc[ar]")
+
+# Dimension names accepted by restore besides folder names.
+DIMENSION_ALIASES = {"nether": "DIM-1", "end": "DIM1"}
+
+def manifest_comment(path):
+    world_file = manifest[path]
+    return archive.format_manifest_comment(world_file.size, world_file.mtime_ns)
+
+
+def manifest_date_time(path):
+    return datetime.datetime.fromtimestamp(manifest[path].mtime).timetuple()
+
+
+def recompress_chunk_data(data, compression, iterations=None):
+    # Runs inside worker processes, so it must only depend on "args" and
+    # "cache".
+    time_s = time.perf_counter()
+    cpu_s = time.process_time()
+
+    cache_hit = None
+    checksum = None
+
+    # Chunk is decompressed once, for the key, the checksum and
+    # recompression. Broken chunks are reported, so their region can be
+    # archived as is.
+    try:
+        current_chunk = chunk.Chunk(0, 0, None, chunk.Chunk(0, 0, None, data, compression).decompress_chunk(), 3)
+    except chunk.DECOMPRESSION_ERRORS as e:
+        raise chunk.ChunkDataError(str(e)) from None
+
+    if args.verify:
+        checksum = zlib.crc32(current_chunk.data)
+
+    if cache is not None:
+        key = cache.make_key(current_chunk.data, recompression_settings(iterations))
+        cached = cache.get(key)
+
+        if cached is not None:
+            return (cached[0], cached[1], True, verify_chunk_data(cached[0], cached[1], checksum),
+                    time.perf_counter() - time_s, time.process_time() - cpu_s)
+
+        cache_hit = False
+
+    compression_level, zopfli_chunk, iterations = chunk_settings(iterations)
+
+    if args.sector_budgeting:
+        current_chunk.recompress_chunk_sector_aware(compression_scheme_mappings[args.compression_scheme],
+                                                    compression_level,
+                                                    zopfli_chunk,
+                                                    iterations,
+                                                    args.zopfli_disable_block_splitting,
+                                                    args.zopfli_block_splitting_max)
+    elif zopfli_chunk:
+        current_chunk.recompress_chunk_zopfli(compression_scheme_mappings[args.compression_scheme],
+                                              iterations,
+                                              args.zopfli_disable_block_splitting,
+                                              args.zopfli_block_splitting_max)
+    else:
+        current_chunk.recompress_chunk(compression_scheme_mappings[args.compression_scheme],
+                                       compression_level)
+
+    verified = verify_chunk_data(current_chunk.data, current_chunk.compression, checksum)
+
+    if cache is not None and verified is not False:
+        cache.put(key, current_chunk.data, current_chunk.compression)
+
+    return (current_chunk.data, current_chunk.compression, cache_hit, verified,
+            time.perf_counter() - time_s, time.process_time() - cpu_s)
+
+
+def verify_chunk_data(data, compression, checksum):
+    """
+    Returns whether recompressed chunk data decompresses into data with the
+    given checksum, or None if verification is disabled.
+    """
+    if checksum is None:
+        return None
+
+    try:
+        return chunk.calculate_checksum(data, compression) == checksum
+    except (zlib.error, ValueError, EOFError):
+        return False
+
+
+def chunk_settings(iterations=None):
+    """
+    Returns compression level, whether Zopfli is used and its iteration
+    count. Chunks given no iterations by the time budget fall back to zlib
+    level 9.
+    """
+    if iterations is None:
+        iterations = args.zopfli_iterations
+
+    if args.zopfli_chunk and iterations == 0:
+        return (args.compression_level if args.sector_budgeting else 9), False, 0
+
+    return args.compression_level, args.zopfli_chunk, iterations
+
+
+def recompression_settings(iterations=None):
+    compression_level, zopfli_chunk, iterations = chunk_settings(iterations)
+    settings = f"{args.compression_scheme};{compression_level}"
+
+    if args.sector_budgeting:
+        settings += ";sector-budgeting"
+
+    if zopfli_chunk:
+        settings += (f";zopfli;{iterations};"
+                     f"{args.zopfli_disable_block_splitting};{args.zopfli_block_splitting_max}")
+
+    return settings
+
+
+def open_cache():
+    if args.cache_dir is None:
+        return None
+
+    return RecompressionCache(os.path.join(args.cache_dir, "anvilord-cache.sqlite3"),
+                              args.cache_size * 1024 ** 2)
+
+
+def init_worker(worker_args):
+    global args, cache
+    args = worker_args
+    cache = open_cache()
+
+
+def region_files_integrity():
+    for i, world_file in enumerate(regions):
+        path = world_file.path
+
+        try:
+            report_region_problems(path, region.check_region_file(path))
+        except region.HeadersErrorException:
+            print(f'"{path}" has empty headers.')
+
+
+def report_region_problems(path, problems):
+    for problem in problems:
+        print(f'"{path}": {problem}')
+
+
+def submit_region_file(pool, path, current_region, base_region=None):
+    job = RegionJob(path, current_region)
+
+    for x in range(1024):
+        x_loc = x % 32
+        z_loc = x // 32
+
+        current_chunk = current_region.get_chunk(x_loc, z_loc)
+
+        if current_chunk is None:
+            continue
+
+        stats.total_chunks += 1
+        job.source_sections += current_chunk.calculate_sections()
+
+        if (not args.disable_quick_compression
+            and current_chunk.calculate_sections() == 1):
+            stats.skipped_chunks += 1
+            continue
+
+        # Chunk wasn't saved since the base archive was made.
+        if base_region is not None:
+            old_chunk = base_region.get_chunk(x_loc, z_loc)
+
+            if (old_chunk is not None
+                and current_chunk.timestamp != 0
+                and old_chunk.timestamp == current_chunk.timestamp):
+                current_chunk.data = bytes(old_chunk.data)
+                current_chunk.compression = old_chunk.compression
+                stats.reused_chunks += 1
+                continue
+
+        job.futures[(z_loc, x_loc)] = submit_chunk(pool, current_chunk)
+
+    return job
+
+
+def submit_chunk(pool, current_chunk):
+    if budget is None:
+        return pool.submit(recompress_chunk_data, bytes(current_chunk.data), current_chunk.compression)
+
+    sections = current_chunk.calculate_sections()
+    iterations, cost = budget.choose(sections)
+
+    if iterations == 0:
+        stats.fallback_chunks += 1
+
+    future = pool.submit(recompress_chunk_data, bytes(current_chunk.data), current_chunk.compression, iterations)
+
+    # Budget learns from every chunk as soon as it's done, not when its
+    # region is written.
+    def finish(future):
+        if future.exception() is not None:
+            budget.finish(cost, sections, iterations)
+            return
+
+        data, compression, cache_hit, verified, seconds, cpu_seconds = future.result()
+
+        # Cache hits tell nothing about compression costs.
+        if cache_hit:
+            budget.finish(cost, sections, iterations)
+        else:
+            budget.finish(cost, sections, iterations, sections - chunk.calculate_sections(data), cpu_seconds)
+
+    future.add_done_callback(finish)
+
+    return future
+
+
+def squash_region_file(job):
+    current_region = job.region
+    path = job.path
+
+    compressed_region_sections = 0
+    failed_chunks = 0
+    broken_chunks = 0
+
+    # Futures were submitted in chunk order, so the result doesn't depend
+    # on which worker finished first.
+    for (z_loc, x_loc), future in job.futures.items():
+        if args.verbose:
+            print(f"\rRecompressing chunk {z_loc:>2}; {x_loc:>2}...", end="  ")
+
+        current_chunk = current_region.get_chunk(x_loc, z_loc)
+
+        try:
+            current_chunk.data, current_chunk.compression, cache_hit, verified, seconds, cpu_seconds = future.result()
+        except chunk.ChunkDataError as e:
+            if args.verbose:
+                print(f"Chunk {z_loc}; {x_loc} is broken: {e}")
+
+            broken_chunks += 1
+            continue
+
+        stats.recompressed_chunks += 1
+        metrics.add_chunk(seconds, cpu_seconds)
+
+        if cache_hit:
+            stats.cache_hits += 1
+        elif cache_hit is not None:
+            stats.cache_misses += 1
+
+        if verified:
+            stats.verified_chunks += 1
+        elif verified is not None:
+            failed_chunks += 1
+
+    # Region file is rolled back to its original state if any chunk is
+    # broken.
+    if failed_chunks or broken_chunks:
+        if args.verbose:
+            print()
+
+        if failed_chunks:
+            print(f'{failed_chunks} chunks of "{path}" failed verification. Archiving it as is.')
+
+        if broken_chunks:
+            print(f'{broken_chunks} chunks of "{path}" can\'t be decompressed. Archiving it as is.')
+
+        stats.failed_chunks += failed_chunks
+        stats.broken_chunks += broken_chunks
+        current_region.close()
+        archive_file_as_is(path)
+        return
+
+    for x in range(1024):
+        compressed_region_sections += calculate_chunk_sections(current_region, x)
+
+    if compressed_region_sections < job.source_sections:
+        diff = job.source_sections - compressed_region_sections
+        print(f"Saved {diff * 4_096} bytes.")
+        stats.sections_saved += diff
+    elif args.verbose:
+        print()
+
+    if args.verbose:
+        print("Archiving region file.")
+
+    if not args.disable_datetime_preservation:
+        infoobj = zopfli.ZipInfo(path, date_time=manifest_date_time(path))
+    else:
+        infoobj = zopfli.ZipInfo(path)
+
+    infoobj.comment = manifest_comment(path)
+
+    # This forces Zopfli to compress files instead of storing them.
+    infoobj.compress_type = 8
+
+    source_size = len(current_region.mapping)
+
+    if args.output_dir is not None:
+        with worlddir.AtomicFile(output_path(path), path, not args.disable_datetime_preservation) as f:
+            size = current_region.write_region_file(f)
+
+            # Source file may be replaced only after it's unmapped.
+            current_region.close()
+    elif args.adaptive_output and compressible_share(current_region) <= MAX_COMPRESSIBLE_SHARE:
+        # Compressing chunk payloads once again gains nothing.
+        d, infoobj.CRC, size = deflate_region_file(current_region)
+        infoobj.file_size = size
+        infoobj.compress_size = len(d)
+
+        archive.write_raw_entry(arc, infoobj, (d,))
+    elif args.zopfli_output:
+        # Zopfli compresses the whole entry at once, so there's nothing to
+        # gain from streaming.
+        d = current_region.compile_region_file()
+        size = len(d)
+
+        arc.writestr(infoobj,
+                     d,
+                     compress_type=zipfile.ZIP_DEFLATED,
+                     compresslevel=args.compression_level)
+    else:
+        # ZipFile.open() doesn't take compression level.
+        infoobj._compresslevel = args.compression_level
+
+        with arc.open(infoobj, "w") as f:
+            size = current_region.write_region_file(f)
+
+    metrics.add_region(path,
+                       source_size,
+                       size,
+                       job.source_sections,
+                       compressed_region_sections,
+                       sum(1 for offset in current_region.offsets if offset != 0))
+
+    current_region.close()
+
+    if args.verbose:
+        time_re = time.monotonic()
+        print(f"Time elapsed: {display_time(time_re - job.time_s)}")
+
+
+def compressible_share(current_region):
+    sizes = collections.Counter()
+
+    for x in range(1024):
+        current_chunk = current_region.get_chunk(x % 32, x // 32)
+
+        if current_chunk is not None:
+            sizes[current_chunk.compression in COMPRESSIBLE_CHUNK_TYPES] += len(current_chunk.data)
+
+    return sizes[True] / max(1, sizes[True] + sizes[False])
+
+
+def deflate_region_file(current_region):
+    """
+    Returns raw Deflate stream of the region file, its CRC32 and size.
+    Compressed chunks are stored, padding costs a few bits, only headers and
+    compressible chunks are compressed.
+    """
+    layout, size = current_region.calculate_layout()
+    writer = rawdeflate.DeflateWriter()
+
+    writer.compress(current_region.compile_header(layout), args.compression_level)
+
+    for x, current_chunk, chunk_offset, section_count in layout:
+        d = struct.pack(">IB", len(current_chunk.data) + 1, current_chunk.compression) + bytes(current_chunk.data)
+
+        if current_chunk.compression in COMPRESSIBLE_CHUNK_TYPES:
+            writer.compress(d, args.compression_level)
+        else:
+            writer.store(d)
+
+        writer.zeros(section_count * 4096 - len(d))
+
+    return writer.finish(), writer.crc, writer.size
+
+
+def archive_file_as_is(path):
+    if args.output_dir is not None:
+        worlddir.copy_file(path, output_path(path), not args.disable_datetime_preservation)
+        return
+
+    infoobj = create_zip_info(path)
+
+    with open(path, "rb") as f:
+        write_entry_from_file(infoobj, f, zipfile.ZIP_DEFLATED)
+
+
+def create_zip_info(path):
+    if not args.disable_datetime_preservation:
+        infoobj = zipfile.ZipInfo(path, date_time=manifest_date_time(path))
+    else:
+        infoobj = zipfile.ZipInfo(path)
+
+    infoobj.comment = manifest_comment(path)
+
+    return infoobj
+
+
+def write_entry_from_file(infoobj, f, compress_type):
+    """
+    Copies file object into the archive in fixed-size blocks.
+    """
+    if args.zopfli_output and compress_type == zipfile.ZIP_DEFLATED:
+        # Zopfli compresses the whole entry at once, so there's nothing to
+        # gain from streaming.
+        arc.writestr(infoobj,
+                     f.read(),
+                     compress_type=compress_type,
+                     compresslevel=args.compression_level)
+        return
+
+    infoobj.compress_type = compress_type
+
+    # ZipFile.open() doesn't take compression level.
+    infoobj._compresslevel = args.compression_level
+
+    with arc.open(infoobj, "w") as dest:
+        shutil.copyfileobj(f, dest, BLOCK_SIZE)
+
+
+def recompress_gzip_file(f, dest):
+    if args.zopfli_chunk:
+        cobj = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP,
+                                       iterations=args.zopfli_iterations,
+                                       block_splitting=not args.zopfli_disable_block_splitting,
+                                       block_splitting_max=args.zopfli_block_splitting_max)
+    else:
+        cobj = zlib.compressobj(args.compression_level, zlib.DEFLATED, 31)
+
+    checksum = 0
+
+    with gzip.GzipFile(fileobj=f, mode="rb") as gzip_file:
+        while d := gzip_file.read(BLOCK_SIZE):
+            checksum = zlib.crc32(d, checksum)
+            dest.write(cobj.compress(d))
+
+    dest.write(cobj.flush())
+
+    return checksum
+
+
+def verify_gzip_data(f, checksum):
+    f.seek(0)
+
+    try:
+        with gzip.GzipFile(fileobj=f, mode="rb") as gzip_file:
+            result = 0
+
+            while d := gzip_file.read(BLOCK_SIZE):
+                result = zlib.crc32(d, result)
+    except (gzip.BadGzipFile, EOFError, zlib.error):
+        return False
+
+    return result == checksum
+
+
+def create_deflate_compressor(sample=None):
+    """
+    Returns compressor of an entry, or None if it's stored. "sample" is
+    the beginning of entry data, which adaptive output mode picks the
+    compressor by.
+    """
+    # Files in output folder aren't compressed.
+    if args.output_dir is not None:
+        return None
+
+    if args.adaptive_output and sample is not None:
+        ratio = len(zlib.compress(sample, 1)) / len(sample) if sample else 1
+
+        if ratio >= STORE_RATIO:
+            return None
+
+        if ratio >= FAST_DEFLATE_RATIO:
+            return zlib.compressobj(1, zlib.DEFLATED, -15)
+
+    if args.zopfli_output:
+        return zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_DEFLATE)
+
+    return zlib.compressobj(args.compression_level, zlib.DEFLATED, -15)
+
+
+def pack_file(path):
+    """
+    Prepares compressed archive entry of a non-region file. Runs in worker
+    threads, the entry is written into the archive later.
+    """
+    infoobj = create_zip_info(path)
+
+    # Entry is kept in memory unless it's big.
+    temp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    with open(path, "rb") as f:
+        if (not args.disable_gzip_data_recompression
+            and not path.endswith(".json")
+            and f.read(2) == b"\x1f\x8b"):
+            if args.verbose:
+                print(f'"{path}" is gzipped. Recompressing.')
+
+            f.seek(0)
+
+            # Because gzipped files are already compressed, we don't want to
+            # compress them once again with Deflate.
+            entry = archive.EntryWriter(infoobj, temp)
+
+            try:
+                checksum = recompress_gzip_file(f, entry)
+                entry.close()
+
+                if not args.verify or verify_gzip_data(temp, checksum):
+                    return infoobj, temp
+
+                print(f'"{path}" failed verification. Archiving it as is.')
+            except (gzip.BadGzipFile, EOFError, zlib.error) as e:
+                if args.verbose:
+                    print(f'Failed to decompress "{path}": "{e}"')
+
+            temp.seek(0)
+            temp.truncate()
+        elif (not args.disable_json_data_minification
+              and path.endswith(".json")
+              and os.fstat(f.fileno()).st_size <= args.json_minification_max_size * 1024 ** 2):
+            d = f.read()
+
+            try:
+                d = json.dumps(json.loads(d), separators=(",", ":")).encode()
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                if args.verbose:
+                    print(f'Cannot read JSON file "{path}": "{e}"')
+
+            entry = archive.EntryWriter(infoobj, temp, create_deflate_compressor(d[:SAMPLE_SIZE]))
+            entry.write(d)
+            entry.close()
+            return infoobj, temp
+
+        # There's nothing to change in the file, so it's copied later.
+        if args.output_dir is not None:
+            temp.close()
+            return infoobj, None
+
+        f.seek(0)
+        compressor = create_deflate_compressor(f.read(SAMPLE_SIZE))
+        f.seek(0)
+
+        entry = archive.EntryWriter(infoobj, temp, compressor)
+        shutil.copyfileobj(f, entry, BLOCK_SIZE)
+        entry.close()
+
+    return infoobj, temp
+
+
+def write_packed_file(path, future):
+    if future is None:
+        base.copy_entry(path, arc)
+        stats.copied_files += 1
+        return
+
+    infoobj, temp = future.result()
+
+    if args.output_dir is not None:
+        write_output_file(path, temp)
+        return
+
+    with temp:
+        temp.seek(0)
+        archive.write_raw_entry(arc, infoobj, iter(functools.partial(temp.read, BLOCK_SIZE), b""))
+
+
+def write_output_file(path, temp):
+    if temp is None:
+        worlddir.copy_file(path, output_path(path), not args.disable_datetime_preservation)
+        return
+
+    with temp:
+        # Recompressed GZip data can be bigger than the original.
+        if temp.seek(0, io.SEEK_END) >= os.path.getsize(path):
+            worlddir.copy_file(path, output_path(path), not args.disable_datetime_preservation)
+            return
+
+        temp.seek(0)
+
+        with worlddir.AtomicFile(output_path(path), path, not args.disable_datetime_preservation) as f:
+            shutil.copyfileobj(temp, f, BLOCK_SIZE)
+
+
+def output_path(path):
+    return os.path.join(args.output_dir, os.path.relpath(path, args.world))
+
+
+def write_everything_but_region(pool):
+    # Files are packed by worker threads, but they are always archived in
+    # the order they were found.
+    pending = collections.deque()
+
+    for i, path in enumerate(files):
+        if path in finished:
+            if args.verbose:
+                print(f'"{path}" is already archived.')
+
+            stats.resumed_files += 1
+            continue
+
+        if base is not None and base.is_unchanged(path, manifest_comment(path)):
+            if args.verbose:
+                print(f'"{path}" is unchanged. Copying from base archive.')
+
+            future = None
+        else:
+            if args.verbose:
+                print(f'Packing "{path}"...')
+
+            future = pool.submit(pack_file, path)
+
+        pending.append((path, future))
+
+        while len(pending) > args.jobs * 2:
+            path, future = pending.popleft()
+            write_entry(path, write_packed_file, path, future)
+
+    while pending:
+        path, future = pending.popleft()
+        write_entry(path, write_packed_file, path, future)
+
+
+def write_entry(path, fn, *fn_args):
+    """
+    Writes the file into the output with "fn" and records it in the journal.
+    """
+    try:
+        fn(*fn_args)
+    except BaseException:
+        if journal is not None:
+            journal.stop(arc)
+
+        raise
+
+    # Region files are costly to redo, so only their records are synced
+    # right away.
+    if journal is not None:
+        journal.record(path, arc, manifest[path].kind == "region")
+
+
+def iterate_region_files(largest_first=True):
+    if largest_first:
+        # Big regions take longest, started last they would keep the run
+        # going while other workers are idle.
+        world_files = sorted(regions, key=lambda world_file: (-world_file.size, world_file.path))
+    else:
+        world_files = regions
+
+    for i, world_file in enumerate(world_files):
+        yield world_file.path
+
+
+def read_region_file(path):
+    """
+    Returns read region file, or None if it's unchanged since the base
+    archive.
+    """
+    if base is not None and base.is_unchanged(path, manifest_comment(path)):
+        return None
+
+    current_region = region.Region()
+
+    if args.pipeline:
+        # Read-ahead must actually hit the disk, mapped file would be read
+        # lazily on the main thread.
+        with open(path, "rb") as f:
+            current_region.read_from_buffer(f.read())
+    else:
+        current_region.read_from_file(path)
+
+    return current_region
+
+
+def region_sectors(world_file):
+    return max(0, world_file.size - 8192) // 4096
+
+
+def copy_from_base(path):
+    base.copy_entry(path, arc)
+    stats.copied_files += 1
+
+
+def squash_region_files(pool, reader, writer):
+    # Regions are read ahead while workers are busy, but they are always
+    # archived in the order they were found.
+    pending = collections.deque()
+    reads = collections.deque()
+    writes = collections.deque()
+
+    paths = iterate_region_files()
+
+    def write(path, fn, *fn_args):
+        writes.append(writer.submit(write_entry, path, fn, *fn_args))
+
+        while len(writes) > args.read_ahead:
+            writes.popleft().result()
+
+    while True:
+        for path in paths:
+            if path in finished:
+                print(f'"{path}" is already archived.')
+                stats.resumed_files += 1
+                continue
+
+            reads.append((path, reader.submit(read_region_file, path)))
+
+            if len(reads) >= args.read_ahead:
+                break
+
+        if not reads:
+            break
+
+        path, future = reads.popleft()
+
+        print(f'Squashing "{path}"...')
+
+        if budget is not None:
+            budget.start_region(region_sectors(manifest[path]))
+
+        try:
+            current_region = future.result()
+        except region.HeadersErrorException:
+            # Output folder must contain the whole world.
+            if args.output_dir is not None:
+                print(f'"{path}" has empty headers. Copying it as is.')
+                write(path, archive_file_as_is, path)
+            else:
+                print(f'"{path}" has empty headers. Skipped.')
+
+            continue
+
+        if current_region is None:
+            print("Region file is unchanged. Copying from base archive.")
+            write(path, copy_from_base, path)
+            continue
+
+        if args.fused_region_integrity and not args.disable_region_integrity:
+            report_region_problems(path, current_region.problems)
+
+        # Never rebuild damaged region files, chunks with broken
+        # locations would be lost.
+        if current_region.problems:
+            print(f'"{path}" is damaged. Archiving it as is.')
+            current_region.close()
+            write(path, archive_file_as_is, path)
+            continue
+
+        base_region = None
+
+        if base is not None:
+            base_region = base.read_region(path)
+
+        pending.append(submit_region_file(pool, path, current_region, base_region))
+
+        if base_region is not None:
+            base_region.close()
+
+        while len(pending) >= args.jobs:
+            job = pending.popleft()
+            write(job.path, squash_region_file, job)
+
+    while pending:
+        job = pending.popleft()
+        write(job.path, squash_region_file, job)
+
+    while writes:
+        writes.popleft().result()
+
+
+def store_everything_but_region():
+    for i, path in enumerate(files):
+        if args.verbose:
+            print(f'Storing "{path}"...')
+
+        store_file_as_is(path)
+
+
+def store_file_as_is(path):
+    with open(path, "rb") as f:
+        arc.add_file(solid_entry_name(path), f, solid_mtime(path))
+
+
+def submit_solid_region_file(pool, path):
+    current_region = region.Region()
+    current_region.read_from_file(path)
+
+    job = RegionJob(path, current_region)
+
+    # Damaged region files are stored as is.
+    if current_region.problems:
+        return job
+
+    for x in range(1024):
+        current_chunk = current_region.get_chunk(x % 32, x // 32)
+
+        if current_chunk is None:
+            continue
+
+        stats.total_chunks += 1
+        job.futures[x] = pool.submit(solid.unpack_chunk, bytes(current_chunk.data), current_chunk.compression)
+
+    return job
+
+
+def store_solid_region_file(job):
+    current_region = job.region
+    chunks = []
+
+    for x, future in job.futures.items():
+        result = future.result()
+
+        # Chunk data can't be reproduced, so it stays in the region file.
+        if result is None:
+            stats.skipped_chunks += 1
+            continue
+
+        offset, length, nbt, parameters = result
+        chunks.append((current_region.offsets[x] * 4096 + 5 + offset, length, nbt, parameters))
+        stats.recompressed_chunks += 1
+
+    arc.add_region(solid_entry_name(job.path), current_region.mapping, chunks, solid_mtime(job.path))
+    current_region.close()
+
+
+def store_region_files(pool):
+    # Regions are stored in the order they were found.
+    pending = collections.deque()
+
+    # Regions of a dimension stay together, so LZMA finds more redundancy.
+    for path in iterate_region_files(largest_first=False):
+        print(f'Storing "{path}"...')
+
+        try:
+            job = submit_solid_region_file(pool, path)
+        except region.HeadersErrorException:
+            print(f'"{path}" has empty headers. Storing it as is.')
+            store_file_as_is(path)
+            continue
+
+        if args.fused_region_integrity and not args.disable_region_integrity:
+            report_region_problems(path, job.region.problems)
+
+        if job.region.problems:
+            print(f'"{path}" is damaged. Storing it as is.')
+
+        pending.append(job)
+
+        while len(pending) >= args.jobs:
+            store_solid_region_file(pending.popleft())
+
+    while pending:
+        store_solid_region_file(pending.popleft())
+
+
+def solid_entry_name(path):
+    return os.path.relpath(path, args.world).replace(os.sep, "/")
+
+
+def solid_mtime(path):
+    if args.disable_datetime_preservation:
+        return None
+
+    return manifest[path].mtime_ns
+
+
+def estimate_world(pool):
+    """
+    Recompresses a random sample of chunks of every region folder and
+    extrapolates the results to the whole world.
+    """
+    # Chunks are counted from region headers only.
+    counts = collections.defaultdict(list)
+
+    for world_file in regions:
+        try:
+            chunk_count = len(region.read_chunk_indices(world_file.path))
+        except region.HeadersErrorException:
+            continue
+
+        # Dimensions keep "region", "entities" and "poi" folders apart.
+        folder = f"{world_file.dimension}/{os.path.basename(os.path.dirname(world_file.path))}"
+        counts[folder].append((world_file.path, chunk_count))
+
+    # Same seed every time, so estimates of the same world are comparable.
+    rnd = random.Random(0)
+    strata = {}
+    samples = []
+
+    for folder, region_counts in counts.items():
+        population = sum(chunk_count for path, chunk_count in region_counts)
+        strata[folder] = estimate.Stratum(population)
+
+        # Sampled chunk numbers are mapped to regions through running totals.
+        totals = list(itertools.accumulate(chunk_count for path, chunk_count in region_counts))
+        picks = collections.defaultdict(list)
+
+        for n in rnd.sample(range(population), min(args.estimate_samples, population)):
+            i = bisect.bisect_right(totals, n)
+            picks[region_counts[i][0]].append(n - totals[i] + region_counts[i][1])
+
+        for path, positions in picks.items():
+            print(f'Sampling {len(positions)} chunks of "{path}"...')
+
+            for source_sections, future in submit_sampled_chunks(pool, path, positions):
+                samples.append((strata[folder], source_sections, future))
+
+    for stratum, source_sections, future in samples:
+        try:
+            if future is None:
+                sections, seconds = source_sections, 0
             else:
-                regions += search_for_region_folders(temp_path)
+                data, compression, cache_hit, verified, seconds, cpu_seconds = future.result()
+                sections = chunk.calculate_sections(data)
+        except chunk.ChunkDataError:
+            # Regions with broken chunks are archived as is.
+            sections, seconds = source_sections, 0
+
+        stratum.add("bytes_saved", (source_sections - sections) * 4096)
+        stratum.add("size", sections * 4096)
+        stratum.add("seconds", seconds)
 
-    return regions
+    return strata
 
 
-def get_all_files_exclude_region(path):
-    contents = os.listdir(path)
-    files = []
+def submit_sampled_chunks(pool, path, positions):
+    indices = region.read_chunk_indices(path)
 
-    for i, j in enumerate(contents):
-        temp_path = path + "/" + j
+    current_region = region.Region()
+    current_region.read_from_file(path)
 
-        if os.path.isdir(temp_path):
-            if not (temp_path.endswith("region")
-                or temp_path.endswith("entities")
-                or temp_path.endswith("poi")):
-                files += get_all_files_exclude_region(temp_path)
+    # Damaged regions are archived as is, so none of their chunks change.
+    if current_region.problems:
+        print(f'"{path}" is damaged. Its chunks won\'t be recompressed.')
+
+    samples = []
+
+    for position in positions:
+        x = indices[position]
+        current_chunk = current_region.get_chunk(x % 32, x // 32)
+        source_sections = current_chunk.calculate_sections()
+
+        # Skipped chunks are sampled too, they just don't change.
+        if current_region.problems or (not args.disable_quick_compression and source_sections == 1):
+            future = None
         else:
-            files.append(temp_path)
+            future = pool.submit(recompress_chunk_data, bytes(current_chunk.data), current_chunk.compression)
 
-    return files
+        samples.append((source_sections, future))
 
+    current_region.close()
 
-def recompress_chunk(x):
-    x_loc = x % 32
-    z_loc = x // 32
+    return samples
 
-    if current_region.chunks[z_loc][x_loc] is None:
-        return
 
-    stats.total_chunks += 1
+def report_estimate(strata):
+    print(f"Estimate for {args.jobs} jobs with 95% confidence intervals.")
 
-    if (not args.disable_quick_compression
-        and current_region.chunks[z_loc][x_loc].calculate_sections() == 1):
-        stats.skipped_chunks += 1
-        return
-    
-    if args.verbose:
-        print(f"\rRecompressing chunk {z_loc:>2}; {x_loc:>2}...", end="  ")
+    for folder, stratum in strata.items():
+        print()
+        print(f'"{folder}"')
+        print(f"  Chunks:            {stratum.population} ({stratum.sample_size()} sampled)")
+        report_estimate_totals(stratum.estimate("bytes_saved"),
+                               stratum.estimate("size"),
+                               stratum.estimate("seconds"))
 
-    if args.zopfli_chunk:
-        current_region.chunks[z_loc][x_loc].recompress_chunk_zopfli(compression_scheme_mappings[args.compression_scheme],
-                                                                    args.zopfli_iterations,
-                                                                    args.zopfli_disable_block_splitting,
-                                                                    args.zopfli_block_splitting_max)
+    print()
+    print("Total")
+    print(f"  Chunks:            {sum(stratum.population for stratum in strata.values())} "
+          f"({sum(stratum.sample_size() for stratum in strata.values())} sampled)")
+    report_estimate_totals(*(estimate.combine([stratum.estimate(name) for stratum in strata.values()])
+                             for name in ("bytes_saved", "size", "seconds")))
+
+
+def report_estimate_totals(bytes_saved, size, seconds):
+    print(f"  Bytes saved:       {bytes_saved[0]:.0f} ± {estimate.margin(bytes_saved[1]):.0f}")
+    print(f"  Chunk data size:   {size[0]:.0f} ± {estimate.margin(size[1]):.0f}")
+
+    # Workers are assumed to be busy all the time.
+    print(f"  Run time:          {display_time(seconds[0] / args.jobs)} ± "
+          f"{display_time(estimate.margin(seconds[1]) / args.jobs)}")
+
+
+def restore_world():
+    """
+    Extracts Anvilord archive "args.input" into "args.world".
+    """
+    is_solid = solid.is_solid_archive(args.input)
+
+    if args.jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                      initializer=init_restore_worker,
+                                                      initargs=(args, is_solid))
     else:
-        current_region.chunks[z_loc][x_loc].recompress_chunk(compression_scheme_mappings[args.compression_scheme],
-                                                             args.compression_level)
+        init_restore_worker(args, is_solid)
+        pool = InlineExecutor()
 
-    stats.recompressed_chunks += 1
+    pending = collections.deque()
 
+    def collect(limit):
+        while len(pending) > limit:
+            try:
+                size, converted_chunks = pending.popleft().result()
+            except solid.RebuildError as e:
+                print(f"{e} Skipped.")
+                stats.failed_files += 1
+                continue
+
+            stats.restored_files += 1
+            stats.restored_bytes += size
+            stats.converted_chunks += converted_chunks
+
+    with pool:
+        if is_solid:
+            with solid.SolidReader(args.input) as reader:
+                if not reader.zlib_matches():
+                    print(f"Archive was made with zlib {reader.zlib_version}, but zlib "
+                          f"{zlib.ZLIB_RUNTIME_VERSION} is used now. Region files may not be rebuilt.")
+
+                # Solid archive is decompressed here and workers rebuild
+                # region files, so just a few of them are kept in memory.
+                for entry, d in reader.read_entries(lambda entry: is_selected(entry["path"])
+                                                    and is_restorable(entry["path"])):
+                    print(f'Restoring "{entry["path"]}"...')
+                    pending.append(pool.submit(restore_solid_entry, entry, d))
+                    collect(2 * args.jobs)
+        else:
+            for entry_name, name in list_zip_entries():
+                print(f'Restoring "{name}"...')
+                pending.append(pool.submit(restore_zip_entry, entry_name, name))
 
-def region_files_integrity():
-    for i, j in enumerate(region_folders):
-        files = os.listdir(j)
+        collect(0)
 
-        for i2, j2 in enumerate(files):
-            if j2.endswith(".mca") or j2.endswith(".mcr"):
-                path = f"{j}/{j2}"
-                try:
-                    current_region = region.Region()
-                    current_region.read_from_file(path)
-                except region.HeadersErrorException:
-                    print(f'"{path}" has empty headers.')
 
+def list_zip_entries():
+    """
+    Returns names of selected ZIP entries together with their paths inside
+    the world folder, biggest first.
+    """
+    with zipfile.ZipFile(args.input) as arc:
+        infos = [info for info in arc.infolist() if not info.is_dir()]
+        comment = arc.comment
 
-def squash_region_file():
-    if args.verbose:
-        time_rs = time.monotonic()
+    # Entry names start with the world path the archive was made from.
+    prefix = find_world_prefix(comment, [info.filename for info in infos])
+    entries = []
 
-    source_region_sections     = 0
-    compressed_region_sections = 0
+    for info in sorted(infos, key=lambda info: -info.compress_size):
+        if not info.filename.startswith(prefix):
+            print(f'"{info.filename}" is outside the world folder. Skipped.')
+            continue
 
-    for x in range(1024):
-        source_region_sections += calculate_chunk_sections(x)
-        recompress_chunk(x)
-        compressed_region_sections += calculate_chunk_sections(x)
+        name = info.filename[len(prefix):]
 
-    if compressed_region_sections < source_region_sections:
-        diff = source_region_sections - compressed_region_sections
-        print(f"Saved {diff * 4_096} bytes.")
-        stats.sections_saved += diff
-    elif args.verbose:
-        print()
+        if is_selected(name) and is_restorable(name):
+            entries.append((info.filename, name))
 
-    if args.verbose:
-        print("Archiving region file.")
+    return entries
 
-    if not args.disable_datetime_preservation:
-        date_time = os.path.getmtime(path)
-        date_time = datetime.datetime.fromtimestamp(date_time).timetuple()
-        infoobj = zopfli.ZipInfo(path, date_time=date_time)
+
+def find_world_prefix(comment, names):
+    """
+    Returns the world path, which entry names start with. Archives, which
+    don't record it, use the deepest folder all entries are in.
+    """
+    try:
+        return json.loads(comment)["world"]
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    folders = [name.split("/")[:-1] for name in names]
+    prefix = ""
+
+    for parts in zip(*folders):
+        if any(part != parts[0] for part in parts):
+            break
+
+        prefix += parts[0] + "/"
+
+    return prefix
+
+
+def world_entry_prefix():
+    # Entry names are paths of world files, as the world index makes them.
+    return zipfile.ZipInfo(args.world + "/level.dat").filename[:-len("level.dat")]
+
+
+def parse_region_name(name):
+    """
+    Returns dimension and coordinates of a region file, or None if "name"
+    isn't a region file. Coordinates are None if the file name has none.
+    """
+    folder, _, file_name = name.rpartition("/")
+    parent, _, folder_name = folder.rpartition("/")
+
+    if not (folder_name.endswith(worldindex.REGION_FOLDERS) and file_name.endswith(worldindex.REGION_EXTENSIONS)):
+        return None
+
+    match = REGION_NAME.fullmatch(file_name)
+
+    if match is None:
+        return parent or "overworld", None
+
+    return parent or "overworld", (int(match[1]), int(match[2]))
+
+
+def parse_region_coordinates(value):
+    try:
+        x, z = value.split(",")
+        return int(x), int(z)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{value}" isn\'t in X,Z form.')
+
+
+def is_selected(name):
+    if args.dimension is None and args.region is None:
+        return True
+
+    # Only region files are selected by area.
+    region_name = parse_region_name(name)
+
+    if region_name is None:
+        return False
+
+    dimension, coordinates = region_name
+
+    if (args.dimension is not None
+        and dimension not in (DIMENSION_ALIASES.get(value, value) for value in args.dimension)):
+        return False
+
+    return args.region is None or coordinates in args.region
+
+
+def init_restore_worker(worker_args, is_solid):
+    global args, source
+    args = worker_args
+
+    # Every worker reads the ZIP archive on its own.
+    source = None if is_solid else zipfile.ZipFile(args.input)
+
+
+def restore_zip_entry(entry_name, name):
+    info = source.getinfo(entry_name)
+    manifest = archive.parse_manifest_comment(info.comment)
+
+    if manifest is not None:
+        mtime_ns = manifest[1]
     else:
-        infoobj = zopfli.ZipInfo(path)
+        mtime_ns = int(time.mktime(info.date_time + (0, 0, -1)) * 1e9)
 
-    # This forces Zopfli to compress files instead of storing them.
-    infoobj.compress_type = 8
+    # Unix permissions are kept in the high bits of external attributes.
+    mode = info.external_attr >> 16 & 0o777 or None
 
-    arc.writestr(infoobj,
-                 current_region.compile_region_file(),
-                 compress_type=zipfile.ZIP_DEFLATED,
-                 compresslevel=args.compression_level)
+    if args.compression_scheme is not None and parse_region_name(name) is not None:
+        return restore_data(name, source.read(info), mtime_ns, mode)
 
-    if args.verbose:
-        time_re = time.monotonic()
-        print(f"Time elapsed: {display_time(time_re - time_rs)}")
+    with source.open(info) as src, worlddir.AtomicFile(restore_path(name), mode=mode) as dst:
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
 
+    set_restored_mtime(name, mtime_ns)
 
-def write_everything_but_region():
-    for i, path in enumerate(files):
-        gzipped = False
+    return info.file_size, 0
 
-        if args.verbose:
-            print(f'Packing "{path}"...')
 
-        with open(path, "rb") as f:
-            if (not args.disable_gzip_data_recompression
-                and not path.endswith(".json")):
-                magic = f.read(2)
-                f.seek(0)
-                d = f.read()
-                # Check if current file was gzipped.
-                if magic == b"\x1f\x8b":
-                    if args.verbose:
-                        print("File is gzipped. Recompressing.")
-                    gzipped = True
-            elif (not args.disable_json_data_minification
-                  and path.endswith(".json")):
-                d = f.read()
-
-                try:
-                    d_jsoned = json.loads(d)
-                except json.JSONDecodeError as e:
-                    if args.verbose:
-                        print(f'Cannot read JSON file: "{e}"')
-
-                d = json.dumps(d_jsoned, separators=(",", ":"))
-            else:
-                d = f.read()
+def restore_solid_entry(entry, d):
+    return restore_data(entry["path"], solid.unpack_entry(entry, d), entry.get("mtime_ns"))
 
-        if not args.disable_datetime_preservation:
-            date_time = os.path.getmtime(path)
-            date_time = datetime.datetime.fromtimestamp(date_time).timetuple()
-            infoobj = zipfile.ZipInfo(path, date_time=date_time)
-        else:
-            infoobj = zipfile.ZipInfo(path)
 
-        if gzipped:
-            try:
-                d_decompressed = gzip.decompress(d)
-            except gzip.BadGzipFile as e:
-                if args.verbose:
-                    print(f'Failed to decompress: "{e}"')
-                gzipped = False
-
-        if gzipped and args.zopfli_chunk:
-            cobj = zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP,
-                                           iterations=args.zopfli_iterations,
-                                           block_splitting=not args.zopfli_disable_block_splitting,
-                                           block_splitting_max=args.zopfli_block_splitting_max)
-            d = cobj.compress(d_decompressed) + cobj.flush()
-        elif gzipped and not args.zopfli_chunk:
-            d = gzip.compress(d_decompressed, compresslevel=args.compression_level)
-
-        # This forces Zopfli to compress files instead of storing them.
-        infoobj.compress_type = 8
-
-        # Because gzipped files are already compressed, we don't want to
-        # compress them once again with Deflate.
-        if not gzipped:
-            arc.writestr(infoobj,
-                         d,
-                         compress_type=zipfile.ZIP_DEFLATED,
-                         compresslevel=args.compression_level)
+def restore_data(name, d, mtime_ns=None, mode=None):
+    """
+    Writes a restored file. Chunks of region files are converted to the
+    chosen scheme first.
+    """
+    current_region = None
+    converted_chunks = 0
+
+    if args.compression_scheme is not None and parse_region_name(name) is not None:
+        current_region, converted_chunks = convert_region(d)
+
+    with worlddir.AtomicFile(restore_path(name), mode=mode) as f:
+        if current_region is not None:
+            size = current_region.write_region_file(f)
+            current_region.close()
         else:
-            arc.writestr(infoobj,
-                         d,
-                         compress_type=zipfile.ZIP_STORED,
-                         compresslevel=0)
+            size = f.write(d)
+
+    set_restored_mtime(name, mtime_ns)
+
+    return size, converted_chunks
+
+
+def convert_region(d):
+    """
+    Returns region with chunks converted to the chosen scheme and number of
+    converted chunks. Damaged regions aren't converted at all, chunks which
+    can't be converted are kept as they are.
+    """
+    current_region = region.Region()
+
+    try:
+        current_region.read_from_buffer(d)
+    except region.HeadersErrorException:
+        return None, 0
+
+    if current_region.problems:
+        current_region.close()
+        return None, 0
+
+    target = compression_scheme_mappings[args.compression_scheme]
+    converted_chunks = 0
+
+    for x in range(1024):
+        current_chunk = current_region.get_chunk(x % 32, x // 32)
+
+        if current_chunk is None or current_chunk.compression == target:
+            continue
+
+        data, compression = current_chunk.data, current_chunk.compression
+
+        try:
+            current_chunk.recompress_chunk(target, args.compression_level)
+        except (zlib.error, OSError, EOFError, ValueError, RuntimeError):
+            continue
 
+        # Region file can't hold chunks bigger than 255 sectors.
+        if current_chunk.calculate_sections() > 255:
+            current_chunk.data, current_chunk.compression = data, compression
+            continue
 
-def calculate_chunk_sections(x):
+        converted_chunks += 1
+
+    return current_region, converted_chunks
+
+
+def restore_path(name):
+    """
+    Returns where a file is restored. Raises ValueError if it's outside the
+    world folder.
+    """
+    parts = name.split("/")
+
+    if (not name
+        or "\\" in name
+        or ".." in parts
+        or name.startswith("/")
+        or os.path.isabs(name)
+        or os.path.splitdrive(name)[0]):
+        raise ValueError(f'"{name}" is outside the world folder.')
+
+    path = os.path.join(args.world, *parts)
+
+    # Symbolic links inside the world may still lead out of it.
+    world = os.path.realpath(args.world)
+
+    if os.path.commonpath([world, os.path.realpath(path)]) != world:
+        raise ValueError(f'"{name}" is outside the world folder.')
+
+    return path
+
+
+def is_restorable(name):
+    try:
+        restore_path(name)
+    except ValueError as e:
+        print(f"{e} Skipped.")
+        return False
+
+    return True
+
+
+def set_restored_mtime(name, mtime_ns):
+    if mtime_ns is not None:
+        os.utime(restore_path(name), ns=(mtime_ns, mtime_ns))
+
+
+def calculate_chunk_sections(current_region, x):
     x_loc = x % 32
     z_loc = x // 32
 
-    if current_region.chunks[z_loc][x_loc] is None:
+    if current_region.get_chunk(x_loc, z_loc) is None:
         return 0
 
-    return current_region.chunks[z_loc][x_loc].calculate_sections()
+    return current_region.get_chunk(x_loc, z_loc).calculate_sections()
+
+
+def journal_path():
+    if args.output_dir is not None:
+        return os.path.normpath(args.output_dir) + ".journal"
+
+    return args.output + ".journal"
+
+
+def open_journal():
+    """
+    Returns the journal and records of files finished by the interrupted run.
+    """
+    if not (args.journal or args.resume):
+        return None, []
+
+    records = []
+
+    if args.resume:
+        archive_size = None
+
+        if args.output is not None:
+            archive_size = os.path.getsize(args.output) if os.path.exists(args.output) else 0
+
+        settings, records = checkpoint.read_journal(journal_path(), archive_size)
+
+        if settings is None:
+            print(f'"{journal_path()}" is damaged. Starting over.')
+        elif settings != json.loads(archive_settings()):
+            print(f'"{journal_path()}" was made with different settings. Starting over.')
+            records = []
+
+    return checkpoint.Journal(journal_path(), json.loads(archive_settings()), records), records
+
+
+def resume_archive(records):
+    """
+    Reopens the interrupted archive and drops everything written after the
+    last journaled entry.
+    """
+    end = records[-1]["end"]
+
+    f = open(args.output, "r+b")
+    f.truncate(end)
+    f.seek(end)
+
+    if args.zopfli_output:
+        arc = zopfli.ZipFile(f, "w")
+    else:
+        arc = zipfile.ZipFile(f, "w")
+
+    # Archive owns the file, as if it opened it itself.
+    arc._filePassed = 0
+
+    for record in records:
+        for d in record["entries"]:
+            info = checkpoint.info_from_dict(d)
+            arc.filelist.append(info)
+            arc.NameToInfo[info.filename] = info
+
+    return arc
+
+
+def archive_settings():
+    """
+    Settings which affect archive contents. Base archive can be reused only
+    if it was made with the same settings.
+    """
+    keys = ("disable_quick_compression", "disable_datetime_preservation",
+            "disable_gzip_data_recompression", "disable_json_data_minification",
+            "compression_scheme", "compression_level", "sector_budgeting", "zopfli_chunk", "zopfli_output",
+            "zopfli_iterations", "zopfli_disable_block_splitting", "zopfli_block_splitting_max")
+
+    settings = {key: getattr(args, key) for key in keys}
+
+    # Restore strips the world path from entry names.
+    settings["world"] = world_entry_prefix()
+
+    return json.dumps(settings, sort_keys=True)
+
+
+def open_base():
+    if args.base is None:
+        return None
+
+    base = archive.BaseArchive(args.base)
+
+    if base.settings != json.loads(archive_settings()):
+        print(f'"{args.base}" was made with different settings. It won\'t be used.')
+        base.close()
+        return None
+
+    return base
+
+
+def write_diagnostics():
+    """
+    Writes the profile and metrics of the run, if they were asked for.
+    """
+    if args.profile is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+        if args.verbose:
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+    if args.metrics is not None:
+        metrics.write(args.metrics, vars(stats))
 
 
 def display_time(time):
@@ -226,28 +1462,82 @@ def display_time(time):
     return f"{hours:0>2}:{minutes:0>2}:{seconds:0>2}"
 
 
+class InlineExecutor(concurrent.futures.Executor):
+    """
+    Executor that runs submitted work immediately. Used when "--jobs" is 1.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+        return future
+
+
+class RegionJob:
+    def __init__(self, path, current_region):
+        self.path = path
+        self.region = current_region
+        self.futures = {}
+        self.source_sections = 0
+        self.time_s = time.monotonic()
+
+
 class Stats:
     def __init__(self):
         self.total_chunks = 0
         self.skipped_chunks = 0
         self.recompressed_chunks = 0
         self.sections_saved = 0
-
-
-if __name__ == "__main__":
-    compression_scheme_mappings = {"gzip": 1, "zlib": 2, "uncompressed": 3}
-
+        self.restored_files = 0
+        self.failed_files = 0
+        self.restored_bytes = 0
+        self.converted_chunks = 0
+        self.fallback_chunks = 0
+        self.broken_chunks = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.reused_chunks = 0
+        self.copied_files = 0
+        self.verified_chunks = 0
+        self.failed_chunks = 0
+        self.resumed_files = 0
+
+
+def create_parser():
     parser = argparse.ArgumentParser(prog="Anvilord",
-                                     description="Lossless Minecraft world compression.")
+                                     description="Lossless Minecraft world compression.",
+                                     epilog='Run "Anvilord restore -h" to see how archives are extracted.')
     parser.add_argument("-w", "--world",
                         help="Minecraft world.",
                         required=True)
-    parser.add_argument("-o", "--output",
-                        help="Minecraft world ZIP file output.",
-                        required=True)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("-o", "--output",
+                        help="Minecraft world ZIP file output.")
+    output.add_argument("--estimate",
+                        help="Recompress a random sample of chunks and estimate savings and run time instead of "
+                             "writing output.",
+                        action="store_true")
+    output.add_argument("--output-dir",
+                        help="Write squashed world into a folder instead of a ZIP file. Files are replaced "
+                             "atomically, so it may be the world folder itself.")
+    parser.add_argument("--format",
+                        default="zip",
+                        choices=("zip", "solid"),
+                        help='Set output format. "solid" stores decompressed chunks in a single LZMA stream, '
+                             'which is much smaller, but can only be extracted by Anvilord. Default: "zip".')
     parser.add_argument("-v", "--verbose",
                         help="Enable debug messages.",
                         action="store_true")
+    parser.add_argument("--metrics",
+                        help="Write stage timings, region sizes and chunk compression latencies to a JSON file.")
+    parser.add_argument("--profile",
+                        help="Profile the run with cProfile and write its stats to a file. Worker processes "
+                             "aren't profiled.")
     parser.add_argument("--version",
                         action="version",
                         help="Show program's version and exit.",
@@ -256,14 +1546,52 @@ if __name__ == "__main__":
     # Groups.
     general = parser.add_argument_group("General")
     compression = parser.add_argument_group("Compression")
+    caching = parser.add_argument_group("Cache")
 
     # General.
+    general.add_argument("-j", "--jobs",
+                        type=int,
+                        default=1,
+                        help="Recompress chunks using N worker processes and pack other files using N threads. "
+                             "Use 0 for all CPU cores. Default: 1.")
+    general.add_argument("--pipeline",
+                        help="Read upcoming region files and write finished ones in background threads.",
+                        action="store_true")
+    general.add_argument("--read-ahead",
+                        type=int,
+                        default=2,
+                        help="Set how many region files are read ahead and queued for writing in pipelined "
+                             "mode. Default: 2.")
+    general.add_argument("--time-budget",
+                        type=float,
+                        help="Finish in about this many seconds. Zopfli iterations are tuned per chunk, "
+                             "chunks fall back to zlib level 9 when time runs low. Requires --zopfli-chunk.")
+    general.add_argument("--estimate-samples",
+                        type=int,
+                        default=200,
+                        help="Set how many chunks are sampled per region folder in estimate mode. Default: 200.")
+    general.add_argument("--verify",
+                        help="Check that every recompressed chunk and GZip file decompresses into the original "
+                             "data. Region files with broken chunks are archived as is.",
+                        action="store_true")
+    general.add_argument("--journal",
+                        help="Record every finished file in a journal next to the output, so an interrupted run "
+                             "can be resumed.",
+                        action="store_true")
+    general.add_argument("--resume",
+                        help="Resume an interrupted journaled run. Files it finished aren't processed again.",
+                        action="store_true")
+    general.add_argument("--base",
+                        help="Reuse unchanged files and chunks from a previous Anvilord archive.")
     general.add_argument("--disable-quick-compression",
                         help="Disable skipping of one-sectioned chunks.",
                         action="store_true")
     general.add_argument("--disable-region-integrity",
                         help="Disable quick region file integrity check.",
                         action="store_true")
+    general.add_argument("--fused-region-integrity",
+                        help="Check region file headers while squashing instead of in a separate pass.",
+                        action="store_true")
     general.add_argument("--disable-datetime-preservation",
                         help="Disable modified datetime preservation.",
                         action="store_true")
@@ -273,18 +1601,26 @@ if __name__ == "__main__":
     general.add_argument("--disable-json-data-minification",
                         help="Disable JSON data minification.",
                         action="store_true")
+    general.add_argument("--json-minification-max-size",
+                        type=int,
+                        default=64,
+                        help="Archive JSON files bigger than this size in MiB without minification. Default: 64.")
 
     # Compression.
     compression.add_argument("-s", "--compression-scheme",
                         default="zlib",
                         choices=tuple(compression_scheme_mappings.keys()),
                         help='Override chunk compression scheme. Default: "zlib". Uncompressed is supported for '
-                             'Minecraft 1.15.1+ only.')
+                             'Minecraft 1.15.1+ only, LZ4 for Minecraft 1.20.5+ only.')
     compression.add_argument("-c", "--compression-level",
                         type=int,
                         default=9,
                         choices=range(1, 10),
                         help="Set compression level for reference tools. Default: 9.")
+    compression.add_argument("--sector-budgeting",
+                        help="Try stronger compression, including Zopfli, only on chunks where it can save a "
+                             "sector.",
+                        action="store_true")
     compression.add_argument("--zopfli-chunk",
                         help="Use Zopfli to compress Minecraft chunks. Brutally slower, but more effective.",
                         action="store_true")
@@ -294,6 +1630,11 @@ if __name__ == "__main__":
     compression.add_argument("--zopfli-output",
                         help="Use Zopfli to compress ZIP output.",
                         action="store_true")
+    compression.add_argument("--adaptive-output",
+                        help="Choose how every ZIP entry is compressed. Files are sampled and stored, compressed "
+                             "with fast Deflate or with the configured method, chunks of region files aren't "
+                             "compressed once again.",
+                        action="store_true")
     compression.add_argument("--zopfli-iterations",
                         type=int,
                         default=15,
@@ -306,57 +1647,315 @@ if __name__ == "__main__":
                         default=15,
                         help="Set maximum block splitting. Default: 15.")
 
+    # Cache.
+    caching.add_argument("--cache-dir",
+                        help="Cache recompressed chunks in this folder and reuse them in later runs.")
+    caching.add_argument("--cache-size",
+                        type=int,
+                        default=1024,
+                        help="Set maximum cache size in MiB. Default: 1024.")
+
+    return parser
+
+
+def create_restore_parser():
+    parser = argparse.ArgumentParser(prog="Anvilord restore",
+                                     description="Extract an Anvilord archive into a world folder.")
+    parser.add_argument("-i", "--input",
+                        help="Anvilord ZIP or solid archive.",
+                        required=True)
+    parser.add_argument("-w", "--world",
+                        help="World folder to extract into. Existing files are replaced.",
+                        required=True)
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        default=1,
+                        help="Extract files using N worker processes. Use 0 for all CPU cores. Default: 1.")
+    parser.add_argument("-s", "--compression-scheme",
+                        choices=tuple(compression_scheme_mappings.keys()),
+                        help="Convert chunks of region files to this scheme, e.g. to uncompressed or LZ4 for "
+                             "faster chunk loading. Default: keep chunks as they are archived.")
+    parser.add_argument("-c", "--compression-level",
+                        type=int,
+                        default=6,
+                        choices=range(1, 10),
+                        help="Set compression level of converted GZip and zlib chunks. Default: 6.")
+
+    selection = parser.add_argument_group("Selection",
+                                          "Only region files are extracted when a selection is given.")
+    selection.add_argument("--dimension",
+                        action="append",
+                        help='Extract region files of this dimension, e.g. "overworld", "nether", "end" or '
+                             '"DIM-1". May be repeated.')
+    selection.add_argument("--region",
+                        action="append",
+                        type=parse_region_coordinates,
+                        metavar="X,Z",
+                        help='Extract region files with these region coordinates, e.g. "--region=-1,0". May be '
+                             'repeated.')
+
+    return parser
+
+
+def restore_main(argv):
+    global args, stats
+
+    parser = create_restore_parser()
+    args = parser.parse_args(argv)
+
+    if args.jobs < 0:
+        parser.error("argument -j/--jobs: must be 0 or greater.")
+
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+
+    if not os.path.isfile(args.input):
+        parser.error(f'argument -i/--input: "{args.input}" doesn\'t exist')
+
+    stats = Stats()
+    time_s = time.monotonic()
+
+    restore_world()
+
+    print("Complete! Anvilord restored your world.")
+    print()
+    print(f"Restored files:      {stats.restored_files}")
+    print(f"Restored bytes:      {stats.restored_bytes}")
+
+    if args.compression_scheme is not None:
+        print(f"Converted chunks:    {stats.converted_chunks}")
+
+    if stats.failed_files:
+        print(f"Failed files:        {stats.failed_files}")
+
+    print()
+    print(f"Total time elapsed:  {display_time(time.monotonic() - time_s)}")
+
 
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    if sys.argv[1:2] == ["restore"]:
+        restore_main(sys.argv[2:])
+        sys.exit()
+
+    parser = create_parser()
     args = parser.parse_args()
+
+    if args.jobs < 0:
+        parser.error("argument -j/--jobs: must be 0 or greater.")
+
+    if args.read_ahead < 1:
+        parser.error("argument --read-ahead: must be 1 or greater.")
+
+    if args.estimate_samples < 1:
+        parser.error("argument --estimate-samples: must be 1 or greater.")
+
+    if args.estimate and (args.format == "solid" or args.journal or args.resume):
+        parser.error("argument --estimate: not allowed with solid format, --journal or --resume")
+
+    if args.time_budget is not None and not args.zopfli_chunk:
+        parser.error("argument --time-budget: requires --zopfli-chunk")
+
+    if args.time_budget is not None and (args.estimate or args.format == "solid"):
+        parser.error("argument --time-budget: not allowed with --estimate or solid format")
+
+    if args.estimate:
+        # Cached chunks would hide compression time.
+        args.cache_dir = None
+
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+
+    if args.output_dir is not None and args.base is not None:
+        parser.error("argument --base: not allowed with argument --output-dir")
+
+    if args.format == "solid" and args.output_dir is not None:
+        parser.error("argument --format: solid is not allowed with argument --output-dir")
+
+    if args.adaptive_output and (args.format == "solid" or args.output_dir is not None):
+        parser.error("argument --adaptive-output: only allowed with ZIP output")
+
+    if args.format == "solid" and args.base is not None:
+        parser.error("argument --base: not allowed with solid format")
+
+    if args.format == "solid" and (args.journal or args.resume):
+        parser.error("argument --journal/--resume: not allowed with solid format")
+
+    if args.resume and not os.path.exists(journal_path()):
+        parser.error(f'argument --resume: "{journal_path()}" doesn\'t exist')
+
     stats = Stats()
+    metrics = Metrics()
+    cache = open_cache()
+
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    with metrics.stage("world_scan"):
+        world_files = worldindex.scan_world(args.world)
 
-    region_folders = search_for_region_folders(args.world)
+    manifest = {world_file.path: world_file for world_file in world_files}
+    regions = [world_file for world_file in world_files if world_file.kind == "region"]
+    files = [world_file.path for world_file in world_files if world_file.kind == "file"]
 
-    if args.disable_region_integrity is False:
-        print("Checking region files integrity. This can take some time.")
-        region_files_integrity()
+    if not (args.disable_region_integrity or args.fused_region_integrity):
+        print("Checking region files integrity.")
+
+        with metrics.stage("region_integrity"):
+            region_files_integrity()
 
     time_s = time.monotonic()
 
-    files = get_all_files_exclude_region(args.world)
+    if args.estimate:
+        if args.jobs > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                          initializer=init_worker,
+                                                          initargs=(args,))
+        else:
+            pool = InlineExecutor()
+
+        with pool, metrics.stage("estimate"):
+            strata = estimate_world(pool)
 
-    if args.zopfli_output:
+        write_diagnostics()
+
+        print()
+        report_estimate(strata)
+        print()
+        print(f"Total time elapsed:  {display_time(time.monotonic() - time_s)}")
+        sys.exit()
+
+    journal, records = open_journal()
+    finished = {record["path"] for record in records}
+
+    budget = None
+
+    if args.time_budget is not None:
+        # Iterations may go up to four times the configured count on chunks
+        # which pay off.
+        budget = timebudget.TimeBudget(time_s + args.time_budget,
+                                       args.jobs,
+                                       sum(region_sectors(world_file) for world_file in regions
+                                           if world_file.path not in finished),
+                                       4 * args.zopfli_iterations)
+
+    if args.output_dir is not None:
+        arc = None
+    elif records:
+        arc = resume_archive(records)
+    elif args.format == "solid":
+        arc = solid.SolidWriter(args.output, args.compression_level)
+    elif args.zopfli_output:
         arc = zopfli.ZipFile(args.output, "w")
     else:
         arc = zipfile.ZipFile(args.output, "w")
 
+    if args.format == "zip" and arc is not None:
+        arc.comment = archive_settings().encode()
+
+    base = open_base()
+
     print("Packaging non-region files.")
-    write_everything_but_region()
+
+    if args.format == "solid":
+        # LZMA stream is written by a single thread anyway.
+        with metrics.stage("non_region_packing"):
+            store_everything_but_region()
+    else:
+        # zlib and Zopfli release the GIL, so threads are enough here.
+        if args.jobs > 1:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+        else:
+            pool = InlineExecutor()
+
+        with pool, metrics.stage("non_region_packing"):
+            write_everything_but_region(pool)
+
+        if journal is not None:
+            journal.flush(arc)
 
     print("Region files squashing started.")
 
-    for i, j in enumerate(region_folders):
-        files = os.listdir(j)
+    if args.jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                      initializer=init_worker,
+                                                      initargs=(args,))
+    else:
+        pool = InlineExecutor()
+
+    # Archive is written by a single thread, so entries keep their order.
+    if args.pipeline:
+        reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    else:
+        args.read_ahead = 1
+        reader = InlineExecutor()
+        writer = InlineExecutor()
 
-        for i2, j2 in enumerate(files):
-            valid_region = False
-            path = j + "/" + j2
+    with pool, reader, writer, metrics.stage("region_squashing"):
+        if args.format == "solid":
+            store_region_files(pool)
+        else:
+            squash_region_files(pool, reader, writer)
 
-            print(f'Squashing "{path}"...')
+    with metrics.stage("finalization"):
+        if arc is not None:
+            arc.close()
 
-            try:
-                current_region = region.Region()
-                current_region.read_from_file(f"{path}")
-                valid_region = True
-            except region.HeadersErrorException:
-                print(f'"{path}" has empty headers. Skipped.')
+        if cache is not None:
+            cache.evict()
+            cache.close()
 
-            if valid_region:
-                squash_region_file()
+        if base is not None:
+            base.close()
+
+        # Output is complete, nothing to resume anymore.
+        if journal is not None:
+            journal.remove()
 
     time_e = time.monotonic()
 
+    write_diagnostics()
+
     print("Complete! Anvilord carefully recompressed your region files.")
     print()
     print(f"Total chunks:        {stats.total_chunks}")
     print(f"Skipped chunks:      {stats.skipped_chunks}")
     print(f"Compressed chunks:   {stats.recompressed_chunks}")
     print()
-    print(f"Bytes saved:         {stats.sections_saved * 4_096}")
+
+    if args.format == "solid":
+        print(f"Bytes saved:         {arc.source_size - os.path.getsize(args.output)}")
+    else:
+        print(f"Bytes saved:         {stats.sections_saved * 4_096}")
+
+    if budget is not None:
+        print()
+        print(f"Fallback chunks:     {stats.fallback_chunks}")
+
+    if base is not None:
+        print()
+        print(f"Reused chunks:       {stats.reused_chunks}")
+        print(f"Copied files:        {stats.copied_files}")
+
+    if args.verify:
+        print()
+        print(f"Verified chunks:     {stats.verified_chunks}")
+        print(f"Failed chunks:       {stats.failed_chunks}")
+
+    if stats.broken_chunks:
+        print()
+        print(f"Broken chunks:       {stats.broken_chunks}")
+
+    if args.resume:
+        print()
+        print(f"Resumed files:       {stats.resumed_files}")
+
+    if cache is not None:
+        print()
+        print(f"Cache hits:          {stats.cache_hits}")
+        print(f"Cache misses:        {stats.cache_misses}")
     print()
     print(f"Total time elapsed:  {display_time(time_e - time_s)}")
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""
+Library for writing raw entries and reusing entries of previously written
+Anvilord archives.
+"""
+
+import json
+import os
+import struct
+import zipfile
+import zlib
+
+import region
+
+# Prefix of entry comments, which describe the source file of the entry.
+MANIFEST_PREFIX = "anvilord;"
+
+
+def make_manifest_comment(path):
+    st = os.stat(path)
+    return format_manifest_comment(st.st_size, st.st_mtime_ns)
+
+
+def format_manifest_comment(size, mtime_ns):
+    return f"{MANIFEST_PREFIX}{size};{mtime_ns}".encode()
+
+
+def parse_manifest_comment(comment):
+    """
+    Returns size and modification time in nanoseconds of the source file, or
+    None if it's not a manifest comment.
+    """
+    if not comment.startswith(MANIFEST_PREFIX.encode()):
+        return None
+
+    try:
+        size, mtime_ns = comment[len(MANIFEST_PREFIX):].decode().split(";")
+        return int(size), int(mtime_ns)
+    except ValueError:
+        return None
+
+
+def read_raw_entry(f, info, chunk_size=1024 ** 2):
+    """
+    Yields compressed data of a ZIP entry without decompressing it.
+    """
+    f.seek(info.header_offset)
+    header = f.read(30)
+
+    if header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f'Bad local file header of "{info.filename}".')
+
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    f.seek(info.header_offset + 30 + name_length + extra_length)
+
+    remaining = info.compress_size
+
+    while remaining > 0:
+        d = f.read(min(chunk_size, remaining))
+
+        if not d:
+            raise zipfile.BadZipFile(f'"{info.filename}" is truncated.')
+
+        remaining -= len(d)
+        yield d
+
+
+def write_raw_entry(arc, info, raw_data):
+    """
+    Appends already compressed ZIP entry to the archive.
+
+    "info" must contain CRC, compressed and uncompressed sizes of the entry.
+    """
+    # Sizes are known, so local header doesn't need a data descriptor.
+    info.flag_bits &= ~0x08
+
+    with arc._lock:
+        if arc._writing:
+            raise ValueError("Can't write to the archive while another entry is being written.")
+
+        arc._writecheck(info)
+        arc._didModify = True
+
+        arc.fp.seek(arc.start_dir)
+        info.header_offset = arc.fp.tell()
+
+        zip64 = (info.file_size > zipfile.ZIP64_LIMIT
+                 or info.compress_size > zipfile.ZIP64_LIMIT)
+        arc.fp.write(info.FileHeader(zip64))
+
+        for d in raw_data:
+            arc.fp.write(d)
+
+        arc.filelist.append(info)
+        arc.NameToInfo[info.filename] = info
+        arc.start_dir = arc.fp.tell()
+
+
+class EntryWriter:
+    """
+    File-like object, which compresses entry data like ZipFile does and
+    tracks its CRC and sizes, so the entry can be appended to the archive
+    with write_raw_entry() later.
+
+    Data is stored as is if no compressor is given.
+    """
+
+    def __init__(self, info, dest, compressor=None):
+        self.info = info
+        self.dest = dest
+        self.compressor = compressor
+
+        info.compress_type = zipfile.ZIP_STORED if compressor is None else zipfile.ZIP_DEFLATED
+        info.CRC           = 0
+        info.file_size     = 0
+        info.compress_size = 0
+
+
+    def write(self, d):
+        self.info.CRC = zlib.crc32(d, self.info.CRC)
+        self.info.file_size += len(d)
+
+        if self.compressor is not None:
+            self.write_compressed(self.compressor.compress(d))
+        else:
+            self.write_compressed(d)
+
+        return len(d)
+
+
+    def write_compressed(self, d):
+        self.dest.write(d)
+        self.info.compress_size += len(d)
+
+
+    def close(self):
+        if self.compressor is not None:
+            self.write_compressed(self.compressor.flush())
+            self.compressor = None
+
+
+class BaseArchive:
+    """
+    Previous Anvilord archive, which entries are reused when their source
+    files didn't change.
+    """
+
+    def __init__(self, path):
+        self.arc = zipfile.ZipFile(path, "r")
+        self.f = open(path, "rb")
+
+        try:
+            self.settings = json.loads(self.arc.comment)
+        except ValueError:
+            self.settings = None
+
+
+    def get_info(self, path):
+        return self.arc.NameToInfo.get(zipfile.ZipInfo(path).filename)
+
+
+    def is_unchanged(self, path, comment=None):
+        """
+        "comment" is the current manifest comment of the file, if it's known
+        already.
+        """
+        info = self.get_info(path)
+
+        if comment is None:
+            comment = make_manifest_comment(path)
+
+        return (info is not None
+                and info.comment.startswith(MANIFEST_PREFIX.encode())
+                and info.comment == comment)
+
+
+    def copy_entry(self, path, arc):
+        """
+        Copies compressed entry of the file into "arc" as is.
+        """
+        old_info = self.get_info(path)
+
+        info = zipfile.ZipInfo(old_info.filename, date_time=old_info.date_time)
+        info.compress_type = old_info.compress_type
+        info.flag_bits     = old_info.flag_bits
+        info.create_system = old_info.create_system
+        info.external_attr = old_info.external_attr
+        info.comment       = old_info.comment
+        info.CRC           = old_info.CRC
+        info.compress_size = old_info.compress_size
+        info.file_size     = old_info.file_size
+
+        write_raw_entry(arc, info, read_raw_entry(self.f, old_info))
+
+
+    def read_region(self, path):
+        """
+        Returns previously archived region, or None if there's no such entry.
+        """
+        info = self.get_info(path)
+
+        if info is None:
+            return None
+
+        old_region = region.Region()
+
+        try:
+            old_region.read_from_buffer(self.arc.read(info))
+        except region.HeadersErrorException:
+            return None
+
+        return old_region
+
+
+    def close(self):
+        self.f.close()
+        self.arc.close()
@@ -0,0 +1,431 @@
+"""
+Anvilord benchmark. Generates a synthetic world and measures throughput of
+every processing stage.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+from __version__ import __version__
+import anvilord
+import chunk
+import lz4block
+import region
+import worldindex
+
+BLOCK_NAMES = (b"minecraft:air", b"minecraft:stone", b"minecraft:dirt", b"minecraft:grass_block",
+               b"minecraft:deepslate", b"minecraft:water", b"minecraft:gravel", b"minecraft:iron_ore",
+               b"minecraft:coal_ore", b"minecraft:andesite", b"minecraft:oak_log", b"minecraft:oak_leaves")
+
+
+def generate_chunk_nbt(rnd, size):
+    """
+    Generates NBT-like chunk data: sections with block palettes and packed
+    block state arrays, which compress about as well as real chunks.
+    """
+    d = bytearray(b"\x0a\x00\x00")
+
+    while len(d) < size:
+        palette = rnd.sample(BLOCK_NAMES, rnd.randint(1, 6))
+
+        d += b"\x09" + struct.pack(">H", 7) + b"palette" + b"\x0a" + struct.pack(">i", len(palette))
+
+        for name in palette:
+            d += b"\x08" + struct.pack(">H", 4) + b"Name" + struct.pack(">H", len(name)) + name + b"\x00"
+
+        # Mostly repeated words, like terrain made of few blocks.
+        words = [rnd.getrandbits(64) for i in range(len(palette))]
+        d += b"\x0c" + struct.pack(">H", 12) + b"block_states" + struct.pack(">i", 256)
+
+        for i in range(256):
+            d += struct.pack(">Q", rnd.choice(words) if rnd.random() < 0.9 else rnd.getrandbits(64))
+
+    d += b"\x00"
+
+    return bytes(d)
+
+
+def compress_chunk_data(data, compression):
+    if compression == 1:
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    elif compression == 2:
+        return zlib.compress(data, 6)
+    elif compression == 4:
+        return lz4block.compress(data)
+
+    return data
+
+
+def generate_region_file(path, rnd, chunk_count, payload_size, compression):
+    current_region = region.Region()
+
+    for x in rnd.sample(range(1024), chunk_count):
+        # Chunk sizes vary a lot in real worlds.
+        size = int(payload_size * rnd.uniform(0.25, 1.75))
+        scheme = rnd.choice((1, 2, 3)) if compression == 0 else compression
+
+        current_region.set_chunk(x % 32, x // 32, chunk.Chunk(x % 32,
+                                                              x // 32,
+                                                              1_700_000_000 + x,
+                                                              compress_chunk_data(generate_chunk_nbt(rnd, size),
+                                                                                  scheme),
+                                                              scheme))
+
+    with open(path, "wb") as f:
+        current_region.write_region_file(f)
+
+
+def generate_world(path, seed, region_count, chunk_count, payload_size, compression, file_count):
+    """
+    Generates a world with region, entities and poi folders, player data
+    and advancements.
+    """
+    rnd = random.Random(seed)
+
+    for folder in ("region", "entities", "poi", "playerdata", "advancements", "data"):
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    for i in range(region_count):
+        x, z = i % 8, i // 8
+        generate_region_file(f"{path}/region/r.{x}.{z}.mca", rnd, chunk_count, payload_size, compression)
+
+        # Entities and points of interest are much smaller.
+        generate_region_file(f"{path}/entities/r.{x}.{z}.mca", rnd, chunk_count // 4, payload_size // 8, compression)
+        generate_region_file(f"{path}/poi/r.{x}.{z}.mca", rnd, chunk_count // 8, payload_size // 16, compression)
+
+    with open(f"{path}/level.dat", "wb") as f:
+        f.write(gzip.compress(generate_chunk_nbt(rnd, 4096), compresslevel=6, mtime=0))
+
+    for i in range(file_count):
+        with open(f"{path}/playerdata/{i:08x}.dat", "wb") as f:
+            f.write(gzip.compress(generate_chunk_nbt(rnd, 2048), compresslevel=6, mtime=0))
+
+        with open(f"{path}/data/map_{i}.dat", "wb") as f:
+            f.write(gzip.compress(bytes(rnd.choice(b"\x00\x00\x00\x1c\x1d\x22") for j in range(16384)),
+                                  compresslevel=6,
+                                  mtime=0))
+
+        advancements = {f"minecraft:story/step_{j}": {"criteria": {"done": "2024-01-01 00:00:00 +0000"},
+                                                     "done": rnd.random() < 0.5}
+                        for j in range(40)}
+
+        with open(f"{path}/advancements/{i:08x}.json", "w") as f:
+            json.dump(advancements, f, indent=2)
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+
+    def add(self, name, seconds, cpu_seconds, byte_count, chunk_count=None):
+        stage = {"seconds": round(seconds, 6),
+                 "cpu_seconds": round(cpu_seconds, 6),
+                 "bytes": byte_count,
+                 "mb_per_s": round(byte_count / 1024 ** 2 / seconds, 3) if seconds else None}
+
+        if chunk_count is not None:
+            stage["chunks"] = chunk_count
+            stage["chunks_per_s"] = round(chunk_count / seconds, 3) if seconds else None
+
+        self.stages[name] = stage
+
+
+    def run(self, name, func, *args):
+        """
+        Times "func", which must return processed byte count and, optionally,
+        chunk count.
+        """
+        time_s = time.perf_counter()
+        cpu_s = time.process_time()
+        res = func(*args)
+        time_e = time.perf_counter()
+        cpu_e = time.process_time()
+
+        if not isinstance(res, tuple):
+            res = (res,)
+
+        self.add(name, time_e - time_s, cpu_e - cpu_s, *res)
+
+
+def parse_headers(paths):
+    byte_count = 0
+    chunk_count = 0
+
+    for path in paths:
+        current_region = region.Region()
+        current_region.read_from_file(path)
+
+        byte_count += 8192
+        chunk_count += sum(1 for offset in current_region.offsets if offset != 0)
+
+        current_region.close()
+
+    return byte_count, chunk_count
+
+
+def load_chunks(paths):
+    chunks = []
+
+    for path in paths:
+        current_region = region.Region()
+        current_region.read_from_file(path)
+
+        for x in range(1024):
+            current_chunk = current_region.get_chunk(x % 32, x // 32)
+
+            if current_chunk is not None:
+                chunks.append(chunk.Chunk(current_chunk.x,
+                                          current_chunk.z,
+                                          current_chunk.timestamp,
+                                          bytes(current_chunk.data),
+                                          current_chunk.compression))
+
+        current_region.close()
+
+    return chunks
+
+
+def decompress_chunks(chunks):
+    byte_count = 0
+
+    for current_chunk in chunks:
+        byte_count += len(current_chunk.decompress_chunk())
+
+    return byte_count, len(chunks)
+
+
+def decompress_for_recompression(chunks):
+    # Recompression stages time compression only.
+    return [chunk.Chunk(0, 0, 0, current_chunk.decompress_chunk(), 3) for current_chunk in chunks]
+
+
+def recompress_chunks(chunks, scheme, level, use_zopfli):
+    """
+    "chunks" must be uncompressed.
+    """
+    byte_count = 0
+
+    for current_chunk in chunks:
+        temp = chunk.Chunk(0, 0, 0, current_chunk.data, 3)
+        byte_count += len(current_chunk.data)
+
+        if use_zopfli:
+            temp.recompress_chunk_zopfli(scheme)
+        else:
+            temp.recompress_chunk(scheme, level)
+
+    return byte_count, len(chunks)
+
+
+def compile_regions(paths):
+    byte_count = 0
+    chunk_count = 0
+    compiled = []
+
+    for path in paths:
+        current_region = region.Region()
+        current_region.read_from_file(path)
+
+        d = current_region.compile_region_file()
+        compiled.append(d)
+
+        byte_count += len(d)
+        chunk_count += sum(1 for current_chunk in current_region.chunks if current_chunk is not None)
+
+        current_region.close()
+
+    return compiled, byte_count, chunk_count
+
+
+def write_zip(compiled, path, level):
+    byte_count = 0
+
+    with zipfile.ZipFile(path, "w") as arc:
+        for i, d in enumerate(compiled):
+            arc.writestr(f"region/r.{i}.mca", d, compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+            byte_count += len(d)
+
+    return byte_count
+
+
+def pack_files(paths):
+    byte_count = 0
+
+    for path in paths:
+        infoobj, temp = anvilord.pack_file(path)
+        temp.close()
+
+        byte_count += os.path.getsize(path)
+
+    return byte_count
+
+
+def full_run(world, output, jobs):
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "anvilord.py"),
+                    "-w", world, "-o", output, "-j", str(jobs), "--disable-region-integrity"],
+                   check=True,
+                   stdout=subprocess.DEVNULL)
+
+    return sum(world_file.size for world_file in worldindex.scan_world(world))
+
+
+def run_benchmark(args, world, work_dir):
+    timer = StageTimer()
+
+    print("Indexing world.")
+    time_s = time.perf_counter()
+    cpu_s = time.process_time()
+    world_files = worldindex.scan_world(world)
+    timer.add("world_scan", time.perf_counter() - time_s, time.process_time() - cpu_s,
+              sum(world_file.size for world_file in world_files))
+
+    region_files = [world_file.path for world_file in world_files if world_file.kind == "region"]
+    other_files  = [world_file.path for world_file in world_files if world_file.kind == "file"]
+
+    print("Parsing headers.")
+    timer.run("header_parse", parse_headers, region_files)
+
+    chunks = load_chunks(region_files)
+
+    print("Decompressing chunks.")
+    timer.run("decompress", decompress_chunks, chunks)
+
+    uncompressed_chunks = decompress_for_recompression(chunks)
+
+    for scheme, scheme_id in anvilord.compression_scheme_mappings.items():
+        print(f"Recompressing chunks ({scheme}).")
+        timer.run(f"recompress_{scheme}", recompress_chunks, uncompressed_chunks, scheme_id,
+                  args.compression_level, False)
+
+    if args.zopfli:
+        print("Recompressing chunks (Zopfli).")
+        timer.run("recompress_zopfli", recompress_chunks, uncompressed_chunks, 2, args.compression_level, True)
+
+    del uncompressed_chunks
+
+    print("Compiling region files.")
+    time_s = time.perf_counter()
+    cpu_s = time.process_time()
+    compiled, byte_count, chunk_count = compile_regions(region_files)
+    timer.add("compile_region_file", time.perf_counter() - time_s, time.process_time() - cpu_s,
+              byte_count, chunk_count)
+
+    print("Writing ZIP.")
+    timer.run("zip_write", write_zip, compiled, os.path.join(work_dir, "regions.zip"), args.compression_level)
+
+    print("Packing non-region files.")
+    anvilord.args = anvilord.create_parser().parse_args(["-w", world, "-o", os.devnull,
+                                                         "-c", str(args.compression_level)])
+    anvilord.manifest = {world_file.path: world_file for world_file in world_files}
+    timer.run("non_region_packing", pack_files, other_files)
+
+    if not args.skip_full_run:
+        print("Running Anvilord.")
+        timer.run("full_run", full_run, world, os.path.join(work_dir, "world.zip"), args.jobs)
+
+    return {"anvilord_version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "zlib": zlib.ZLIB_RUNTIME_VERSION,
+            "parameters": {"seed": args.seed,
+                           "regions": args.regions,
+                           "chunks": args.chunks,
+                           "payload_size": args.payload_size,
+                           "scheme": args.scheme,
+                           "compression_level": args.compression_level,
+                           "files": args.files,
+                           "jobs": args.jobs},
+            "stages": timer.stages}
+
+
+def print_results(results):
+    print()
+    print(f"{'Stage':<24}{'Time, s':>10}{'MB/s':>10}{'Chunks/s':>12}")
+
+    for name, stage in results["stages"].items():
+        chunks_per_s = stage.get("chunks_per_s")
+        chunks_per_s = "" if chunks_per_s is None else f"{chunks_per_s:.0f}"
+
+        print(f"{name:<24}{stage['seconds']:>10.3f}{stage['mb_per_s'] or 0:>10.2f}{chunks_per_s:>12}")
+
+
+if __name__ == "__main__":
+    schemes = {"mixed": 0, "gzip": 1, "zlib": 2, "uncompressed": 3, "lz4": 4}
+
+    parser = argparse.ArgumentParser(prog="Anvilord benchmark",
+                                     description="Measure Anvilord performance on a synthetic world.")
+    parser.add_argument("-o", "--output",
+                        help="Write results to a JSON file.")
+    parser.add_argument("--world",
+                        help="Generate the world into this folder and keep it. Existing world is reused.")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="Set world generation seed. Default: 0.")
+    parser.add_argument("--regions",
+                        type=int,
+                        default=4,
+                        help="Set region file count. Default: 4.")
+    parser.add_argument("--chunks",
+                        type=int,
+                        default=256,
+                        choices=range(1, 1025),
+                        metavar="{1..1024}",
+                        help="Set chunk count per region file. Default: 256.")
+    parser.add_argument("--payload-size",
+                        type=int,
+                        default=24_000,
+                        help="Set average decompressed chunk size in bytes. Default: 24000.")
+    parser.add_argument("--scheme",
+                        default="zlib",
+                        choices=tuple(schemes.keys()),
+                        help='Set chunk compression scheme of the world. Default: "zlib".')
+    parser.add_argument("--files",
+                        type=int,
+                        default=64,
+                        help="Set player data, map and advancement file count. Default: 64.")
+    parser.add_argument("-c", "--compression-level",
+                        type=int,
+                        default=9,
+                        choices=range(1, 10),
+                        help="Set compression level. Default: 9.")
+    parser.add_argument("-j", "--jobs",
+                        type=int,
+                        default=1,
+                        help="Set Anvilord job count for the full run. Default: 1.")
+    parser.add_argument("--zopfli",
+                        help="Also measure Zopfli chunk recompression.",
+                        action="store_true")
+    parser.add_argument("--skip-full-run",
+                        help="Don't run Anvilord on the whole world.",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="anvilord-benchmark-") as work_dir:
+        world = args.world or os.path.join(work_dir, "world")
+
+        if not os.path.isdir(os.path.join(world, "region")):
+            print("Generating world.")
+            generate_world(world, args.seed, args.regions, args.chunks, args.payload_size,
+                           schemes[args.scheme], args.files)
+
+        results = run_benchmark(args, world, work_dir)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,121 @@
+"""
+Library for caching recompressed chunks between runs.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+# Every connection evicts chunks after this many puts, so the cache stays
+# near its size during long runs, not only after them.
+EVICT_INTERVAL = 256
+
+
+class RecompressionCache:
+    """
+    Content-addressed storage of recompressed chunks, backed by SQLite.
+
+    Chunks are keyed by their decompressed data and recompression settings,
+    so identical chunks are compressed only once, even within one run.
+
+    Size limit covers chunk data. Database file is somewhat larger, because
+    of keys, indices and pages not returned to the file system yet.
+    """
+
+    def __init__(self, path, max_size):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.path = path
+        self.max_size = max_size
+        self.puts = 0
+
+        # Every statement is committed on its own. Worker processes share
+        # the database, so transactions must never be held while compressing.
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+
+        # Pages freed by eviction are given back by incremental vacuum.
+        # Older caches are converted once, which needs a full vacuum.
+        if self.connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.connection.execute("VACUUM")
+
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                                "key BLOB PRIMARY KEY, "
+                                "data BLOB NOT NULL, "
+                                "compression INTEGER NOT NULL, "
+                                "size INTEGER NOT NULL, "
+                                "last_used REAL NOT NULL)")
+        # Sizes are in the index, so eviction doesn't read chunk data.
+        self.connection.execute("DROP INDEX IF EXISTS chunks_last_used")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS chunks_lru ON chunks (last_used, size)")
+
+
+    @staticmethod
+    def make_key(data, settings):
+        h = hashlib.sha256(settings.encode())
+        h.update(data)
+        return h.digest()
+
+
+    def get(self, key):
+        row = self.connection.execute("SELECT data, compression FROM chunks WHERE key = ?",
+                                      (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        self.connection.execute("UPDATE chunks SET last_used = ? WHERE key = ?",
+                                (time.time(), key))
+
+        return row[0], row[1]
+
+
+    def put(self, key, data, compression):
+        self.connection.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                                (key, bytes(data), compression, len(data), time.time()))
+
+        self.puts += 1
+
+        if self.puts % EVICT_INTERVAL == 0:
+            self.evict()
+
+
+    def evict(self):
+        """
+        Removes least recently used chunks until cache fits into its size.
+        Returns number of removed chunks.
+        """
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+
+        if total_size <= self.max_size:
+            return 0
+
+        excess = total_size - self.max_size
+        freed = 0
+        last_used = None
+
+        cursor = self.connection.execute("SELECT size, last_used FROM chunks ORDER BY last_used")
+
+        for size, last_used in cursor:
+            freed += size
+
+            if freed >= excess:
+                break
+
+        cursor.close()
+
+        removed = self.connection.execute("DELETE FROM chunks WHERE last_used <= ?",
+                                          (last_used,)).rowcount
+
+        # sqlite3 steps statements without results once, which frees a
+        # single page. Scripts run until they finish.
+        self.connection.executescript("PRAGMA incremental_vacuum")
+
+        return removed
+
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,170 @@
+"""
+Library for journals of Anvilord runs. A journal records every finished file
+together with its archive entries, so an interrupted run can be resumed.
+"""
+
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+import archive
+import worlddir
+
+# Records of files, which aren't synced on their own, are written after this
+# many files or seconds. Files, whose records got lost, are redone by the
+# resumed run.
+SYNC_FILES = 64
+SYNC_SECONDS = 5
+
+# ZipInfo attributes, which central directory is written from.
+INFO_ATTRIBUTES = ("date_time", "compress_type", "create_system", "create_version", "extract_version",
+                   "reserved", "flag_bits", "volume", "internal_attr", "external_attr", "header_offset",
+                   "CRC", "compress_size", "file_size")
+
+
+def info_to_dict(info):
+    d = {key: getattr(info, key) for key in INFO_ATTRIBUTES}
+    d["filename"] = info.filename
+    d["comment"] = info.comment.hex()
+    d["extra"] = info.extra.hex()
+
+    return d
+
+
+def info_from_dict(d):
+    info = zipfile.ZipInfo(d["filename"])
+
+    for key in INFO_ATTRIBUTES:
+        setattr(info, key, d[key])
+
+    info.date_time = tuple(d["date_time"])
+    info.comment = bytes.fromhex(d["comment"])
+    info.extra = bytes.fromhex(d["extra"])
+
+    return info
+
+
+def read_journal(path, archive_size=None):
+    """
+    Returns settings of the journaled run and its records, which can be
+    reused. Records stop at the first file, which changed since, or which
+    entries aren't completely in the archive. Settings are None if the
+    journal has no readable header.
+    """
+    with open(path) as f:
+        try:
+            settings = json.loads(f.readline())["settings"]
+        except (ValueError, KeyError, TypeError):
+            return None, []
+
+        records = []
+
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Run was interrupted while the record was written.
+                break
+
+            if (not os.path.exists(record["path"])
+                or archive.make_manifest_comment(record["path"]).decode() != record["manifest"]
+                or (archive_size is not None and record.get("end", 0) > archive_size)):
+                break
+
+            records.append(record)
+
+    return settings, records
+
+
+class Journal:
+    def __init__(self, path, settings, records=()):
+        self.path = path
+        self.entry_count = 0
+        self.stopped = False
+        self.pending = [{"settings": settings}]
+        self.synced = time.monotonic()
+
+        # Only records, which are still valid, are carried over.
+        for record in records:
+            self.pending.append(record)
+            self.entry_count += len(record.get("entries", ()))
+
+        # Journal of the interrupted run is replaced only once the new one
+        # holds its records, so a crash meanwhile doesn't lose them.
+        folder, name = os.path.split(path)
+        fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=folder or ".")
+        self.f = os.fdopen(fd, "w")
+
+        try:
+            self.flush()
+            os.chmod(temp_path, 0o666 & ~worlddir.get_umask())
+            os.replace(temp_path, path)
+        except BaseException:
+            self.f.close()
+            os.unlink(temp_path)
+            raise
+
+
+    def record(self, path, arc=None, sync=True):
+        """
+        Records a finished file. Records, which aren't synced, wait for the
+        next synced one, a batch or flush().
+        """
+        if self.stopped:
+            return
+
+        record = {"path": path, "manifest": archive.make_manifest_comment(path).decode()}
+
+        if arc is not None:
+            record["entries"] = [info_to_dict(info) for info in arc.filelist[self.entry_count:]]
+            record["end"] = arc.start_dir
+            self.entry_count = len(arc.filelist)
+
+        self.pending.append(record)
+
+        if sync or len(self.pending) >= SYNC_FILES or time.monotonic() - self.synced >= SYNC_SECONDS:
+            self.flush(arc)
+
+
+    def flush(self, arc=None):
+        """
+        Writes pending records once their entries are on disk.
+        """
+        if not self.pending:
+            return
+
+        if arc is not None:
+            # Entry data must be on disk before the journal says so.
+            arc.fp.flush()
+            os.fsync(arc.fp.fileno())
+
+        for record in self.pending:
+            self.f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+        self.pending = []
+        self.synced = time.monotonic()
+
+
+    def stop(self, arc=None):
+        """
+        Stops recording. Used when an entry failed, the archive might contain
+        its leftovers. Records of files before it are kept.
+        """
+        if not self.stopped:
+            self.flush(arc)
+
+        self.stopped = True
+
+
+    def close(self):
+        self.f.close()
+
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
@@ -7,11 +7,30 @@ import zlib
 
 import zopfli
 
+import lz4block
+
 # GZip, zlib, uncompressed, LZ4 and custom compression schemes.
 valid_compression_schemes = (1, 2, 3, 4, 127,)
 
+# Best expected gain of Zopfli over zlib's maximum compression level.
+ZOPFLI_MAX_GAIN = 0.1
+
+# Chunk data is decompressed in blocks of this size for checksums.
+CHECKSUM_BLOCK_SIZE = 64 * 1024
+
+# Errors raised by broken chunk data or unsupported compression schemes.
+DECOMPRESSION_ERRORS = (zlib.error, gzip.BadGzipFile, EOFError, ValueError, RuntimeError)
+
+
+class ChunkDataError(Exception):
+    """
+    Chunk data can't be decompressed.
+    """
+
 
 class Chunk:
+    __slots__ = ("x", "z", "timestamp", "data", "compression")
+
     def __init__(self, x, z, timestamp, data, compression):
         if compression not in valid_compression_schemes:
             raise ValueError(f"Compression scheme {compression} is invalid.")
@@ -26,10 +45,11 @@ class Chunk:
 
 
     def calculate_sections(self):
-        # 1. No math.ceil() involved!
-        # 2. Compensating chunk header's length in region file.
-        chunk_length = len(self.data) + 5
-        return -(-chunk_length // 4096)
+        return calculate_sections(self.data)
+
+
+    def calculate_checksum(self):
+        return calculate_checksum(self.data, self.compression)
 
 
     def decompress_chunk(self):
@@ -44,7 +64,7 @@ class Chunk:
             return self.data
         # LZ4-compressed chunk.
         elif self.compression == 4:
-            raise NotImplementedError("LZ4 decompression is not implemented.")
+            return lz4block.decompress(self.data)
         elif self.compression == 127:
             raise RuntimeError("Custom compression algorithms are not supported.")
         else:
@@ -61,7 +81,7 @@ class Chunk:
         elif target_compression_type == 3:
             res = data
         elif target_compression_type == 4:
-            raise NotImplementedError("LZ4 compression is not implemented.")
+            res = lz4block.compress(data)
         elif target_compression_type == 127:
             raise RuntimeError("Custom compression algorithms are not supported.")
         else:
@@ -76,16 +96,17 @@ class Chunk:
                                 iterations=15,
                                 block_splitting=True,
                                 block_splitting_max=15):
+        # Zopfli produces Deflate streams only.
+        if target_compression_type in (3, 4):
+            self.recompress_chunk(target_compression_type, 9)
+            return
+
         data = self.decompress_chunk()
 
         if target_compression_type == 1:
             compression_format = zopfli.ZOPFLI_FORMAT_GZIP
         elif target_compression_type == 2:
             compression_format = zopfli.ZOPFLI_FORMAT_ZLIB
-        elif target_compression_type == 3:
-            res = data
-        elif target_compression_type == 4:
-            raise NotImplementedError("LZ4 compression is not implemented.")
         else:
             raise ValueError(f'Unknown compression scheme {target_compression_type}.')
 
@@ -96,4 +117,114 @@ class Chunk:
         res = cobj.compress(data) + cobj.flush()
 
         self.compression = target_compression_type
-        self.data = res
\ No newline at end of file
+        self.data = res
+
+    def recompress_chunk_sector_aware(self,
+                                      target_compression_type,
+                                      compression_level,
+                                      zopfli_enabled=False,
+                                      iterations=15,
+                                      block_splitting=True,
+                                      block_splitting_max=15):
+        """
+        Compresses chunk with zlib first and tries stronger settings only
+        while they are able to save a sector.
+        """
+        if target_compression_type not in (1, 2):
+            self.recompress_chunk(target_compression_type, compression_level)
+            return
+
+        data = self.decompress_chunk()
+
+        if target_compression_type == 1:
+            wbits = 31
+            zopfli_format = zopfli.ZOPFLI_FORMAT_GZIP
+        else:
+            wbits = 15
+            zopfli_format = zopfli.ZOPFLI_FORMAT_ZLIB
+
+        res = compress_deflate(data, wbits, compression_level, zlib.Z_DEFAULT_STRATEGY)
+        boundary = (calculate_sections(res) - 1) * 4096
+
+        candidates = [lambda: compress_deflate(data, wbits, 9, zlib.Z_FILTERED)]
+
+        if compression_level < 9:
+            candidates.insert(0, lambda: compress_deflate(data, wbits, 9, zlib.Z_DEFAULT_STRATEGY))
+
+        if zopfli_enabled:
+            candidates.append(lambda: compress_zopfli(data,
+                                                      zopfli_format,
+                                                      iterations,
+                                                      block_splitting,
+                                                      block_splitting_max))
+
+        for candidate in candidates:
+            # One-sectioned chunks can't get any smaller. None of the
+            # candidates, even Zopfli, is expected to beat zlib by more than
+            # ZOPFLI_MAX_GAIN, so nothing is tried when the boundary is
+            # further away.
+            if (boundary == 0
+                or len(res) + 5 <= boundary
+                or len(res) + 5 - boundary > len(res) * ZOPFLI_MAX_GAIN):
+                break
+
+            temp = candidate()
+
+            if len(temp) < len(res):
+                res = temp
+
+        self.compression = target_compression_type
+        self.data = res
+
+
+def calculate_sections(data):
+    # 1. No math.ceil() involved!
+    # 2. Compensating chunk header's length in region file.
+    chunk_length = len(data) + 5
+    return -(-chunk_length // 4096)
+
+
+def calculate_checksum(data, compression):
+    """
+    Returns CRC32 of decompressed chunk data. Data is decompressed in blocks,
+    so it's never held in memory as a whole.
+    """
+    if compression == 3:
+        return zlib.crc32(data)
+    elif compression == 4:
+        checksum = 0
+
+        for d in lz4block.iter_decompress(data):
+            checksum = zlib.crc32(d, checksum)
+
+        return checksum
+    elif compression not in (1, 2):
+        raise RuntimeError(f"Unknown compression scheme {compression}.")
+
+    dobj = zlib.decompressobj(31 if compression == 1 else 15)
+    checksum = 0
+    tail = data
+
+    while not dobj.eof:
+        d = dobj.decompress(tail, CHECKSUM_BLOCK_SIZE)
+        tail = dobj.unconsumed_tail
+
+        if not d and not tail:
+            raise zlib.error("Compressed data is truncated.")
+
+        checksum = zlib.crc32(d, checksum)
+
+    return checksum
+
+
+def compress_deflate(data, wbits, compression_level, strategy):
+    cobj = zlib.compressobj(compression_level, zlib.DEFLATED, wbits, 9, strategy)
+    return cobj.compress(data) + cobj.flush()
+
+
+def compress_zopfli(data, compression_format, iterations, block_splitting, block_splitting_max):
+    cobj = zopfli.ZopfliCompressor(compression_format,
+                                   iterations=iterations,
+                                   block_splitting=block_splitting,
+                                   block_splitting_max=block_splitting_max)
+    return cobj.compress(data) + cobj.flush()
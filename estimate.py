@@ -0,0 +1,62 @@
+"""
+Library for extrapolating totals from randomly sampled chunks.
+"""
+
+import collections
+import math
+
+# Two-sided 95% confidence.
+Z_95 = 1.96
+
+
+class Stratum:
+    """
+    Chunks of one region folder. Totals are extrapolated from a simple random
+    sample of them.
+    """
+
+    def __init__(self, population):
+        self.population = population
+        self.samples = collections.defaultdict(list)
+
+
+    def add(self, name, value):
+        self.samples[name].append(value)
+
+
+    def sample_size(self):
+        return max((len(values) for values in self.samples.values()), default=0)
+
+
+    def estimate(self, name):
+        """
+        Returns estimated total of "name" and variance of the estimate.
+        """
+        values = self.samples[name]
+        n = len(values)
+
+        if n == 0:
+            return 0, 0
+
+        mean = sum(values) / n
+
+        if n == self.population or n == 1:
+            return mean * self.population, 0
+
+        sample_variance = sum((value - mean) ** 2 for value in values) / (n - 1)
+
+        # Finite population correction, sampling every chunk leaves no error.
+        variance = self.population ** 2 * sample_variance / n * (1 - n / self.population)
+
+        return mean * self.population, variance
+
+
+def combine(estimates):
+    """
+    Sums estimates of independent strata.
+    """
+    return sum(total for total, variance in estimates), sum(variance for total, variance in estimates)
+
+
+def margin(variance):
+    return Z_95 * math.sqrt(variance)
@@ -0,0 +1,304 @@
+"""
+Library for LZ4Block streams, the LZ4 chunk compression scheme of Minecraft.
+
+Streams are written the way lz4-java's LZ4BlockOutputStream does. "lz4" and
+"xxhash" packages are used if they are installed, otherwise pure Python
+implementations are used.
+"""
+
+import struct
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MAGIC = b"LZ4Block"
+
+METHOD_RAW = 0x10
+METHOD_LZ4 = 0x20
+
+# Block size is 2 ** (COMPRESSION_LEVEL_BASE + compression level).
+COMPRESSION_LEVEL_BASE = 10
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+DEFAULT_SEED = 0x9747B28C
+
+# LZ4 block format limits.
+MIN_MATCH = 4
+LAST_LITERALS = 5
+MF_LIMIT = 12
+MAX_DISTANCE = 65535
+
+PRIME32_1 = 2654435761
+PRIME32_2 = 2246822519
+PRIME32_3 = 3266489917
+PRIME32_4 = 668265263
+PRIME32_5 = 374761393
+
+
+def compress(data, block_size=DEFAULT_BLOCK_SIZE):
+    compression_level = block_size.bit_length() - 1 - COMPRESSION_LEVEL_BASE
+
+    if block_size != 1 << (compression_level + COMPRESSION_LEVEL_BASE) or not (0 <= compression_level <= 15):
+        raise ValueError(f"Block size must be a power of two between 1 KiB and 32 MiB. (got {block_size})")
+
+    data = memoryview(data)
+    result = bytearray()
+
+    for i in range(0, len(data), block_size):
+        block = data[i:i + block_size]
+        compressed = compress_block(block)
+        checksum = xxhash32(block, DEFAULT_SEED) & 0xFFFFFFF
+
+        if len(compressed) < len(block):
+            method = METHOD_LZ4
+        else:
+            method = METHOD_RAW
+            compressed = block
+
+        result += MAGIC + struct.pack("<Biii", method | compression_level, len(compressed), len(block), checksum)
+        result += compressed
+
+    # Empty block marks the end of stream.
+    result += MAGIC + struct.pack("<Biii", METHOD_RAW | compression_level, 0, 0, 0)
+
+    return bytes(result)
+
+
+def decompress(data):
+    return b"".join(iter_decompress(data))
+
+
+def iter_decompress(data):
+    """
+    Yields decompressed blocks of the stream one by one.
+    """
+    data = memoryview(data)
+    i = 0
+
+    while i < len(data):
+        if data[i:i + 8] != MAGIC or len(data) < i + 21:
+            raise ValueError("Stream is corrupted: bad block header.")
+
+        token, compressed_length, length, checksum = struct.unpack_from("<Biii", data, i + 8)
+        method = token & 0xF0
+        i += 21
+
+        if length == 0 and compressed_length == 0:
+            break
+
+        if compressed_length < 0 or length < 0 or len(data) < i + compressed_length:
+            raise ValueError("Stream is corrupted: bad block length.")
+
+        block = data[i:i + compressed_length]
+        i += compressed_length
+
+        if method == METHOD_RAW:
+            block = bytes(block)
+        elif method == METHOD_LZ4:
+            block = decompress_block(block, length)
+        else:
+            raise ValueError(f"Stream is corrupted: unknown compression method {method:#x}.")
+
+        if len(block) != length:
+            raise ValueError("Stream is corrupted: bad block length.")
+
+        if xxhash32(block, DEFAULT_SEED) & 0xFFFFFFF != checksum:
+            raise ValueError("Stream is corrupted: checksum mismatch.")
+
+        yield block
+
+
+def compress_block(data):
+    if lz4_block is not None:
+        return lz4_block.compress(data, store_size=False)
+
+    src = bytes(data)
+    n = len(src)
+    result = bytearray()
+    table = {}
+    anchor = 0
+    i = 0
+    misses = 0
+
+    while i < n - MF_LIMIT:
+        key = src[i:i + MIN_MATCH]
+        ref = table.get(key)
+        table[key] = i
+
+        if ref is None or i - ref > MAX_DISTANCE:
+            # Skip faster through data which doesn't compress, like LZ4 does.
+            misses += 1
+            i += 1 + (misses >> 6)
+            continue
+
+        misses = 0
+
+        # Match can't reach into the last literals.
+        match_limit = n - LAST_LITERALS - i
+        match_length = MIN_MATCH
+
+        while (match_length + 32 <= match_limit
+               and src[ref + match_length:ref + match_length + 32] == src[i + match_length:i + match_length + 32]):
+            match_length += 32
+
+        while match_length < match_limit and src[ref + match_length] == src[i + match_length]:
+            match_length += 1
+
+        write_sequence(result, src[anchor:i], i - ref, match_length)
+
+        i += match_length
+        anchor = i
+
+    write_sequence(result, src[anchor:], 0, 0)
+
+    return bytes(result)
+
+
+def write_sequence(result, literals, offset, match_length):
+    literal_length = len(literals)
+    match_code = match_length - MIN_MATCH if match_length else 0
+
+    result.append(min(literal_length, 15) << 4 | min(match_code, 15))
+
+    if literal_length >= 15:
+        write_length(result, literal_length - 15)
+
+    result += literals
+
+    # Last sequence contains literals only.
+    if match_length == 0:
+        return
+
+    result += struct.pack("<H", offset)
+
+    if match_code >= 15:
+        write_length(result, match_code - 15)
+
+
+def write_length(result, length):
+    while length >= 255:
+        result.append(255)
+        length -= 255
+
+    result.append(length)
+
+
+def decompress_block(data, length):
+    if lz4_block is not None:
+        return lz4_block.decompress(data, uncompressed_size=length)
+
+    src = bytes(data)
+    result = bytearray()
+    i = 0
+
+    try:
+        while True:
+            token = src[i]
+            i += 1
+
+            literal_length = token >> 4
+
+            if literal_length == 15:
+                while True:
+                    literal_length += src[i]
+                    i += 1
+
+                    if src[i - 1] != 255:
+                        break
+
+            result += src[i:i + literal_length]
+            i += literal_length
+
+            if i >= len(src):
+                break
+
+            offset = src[i] | src[i + 1] << 8
+            i += 2
+
+            match_length = token & 0x0F
+
+            if match_length == 15:
+                while True:
+                    match_length += src[i]
+                    i += 1
+
+                    if src[i - 1] != 255:
+                        break
+
+            match_length += MIN_MATCH
+
+            if offset == 0 or offset > len(result):
+                raise ValueError("Block is corrupted: bad match offset.")
+
+            start = len(result) - offset
+
+            if offset >= match_length:
+                result += result[start:start + match_length]
+            else:
+                # Overlapping match repeats the last "offset" bytes.
+                pattern = result[start:]
+                result += (pattern * (match_length // offset + 1))[:match_length]
+
+            if len(result) > length:
+                raise ValueError("Block is corrupted: data is longer than expected.")
+    except IndexError:
+        raise ValueError("Block is corrupted: unexpected end of data.")
+
+    return bytes(result)
+
+
+def xxhash32(data, seed=0):
+    if xxhash is not None:
+        return xxhash.xxh32_intdigest(data, seed)
+
+    data = bytes(data)
+    n = len(data)
+    i = 0
+
+    if n >= 16:
+        v1 = (seed + PRIME32_1 + PRIME32_2) & 0xFFFFFFFF
+        v2 = (seed + PRIME32_2) & 0xFFFFFFFF
+        v3 = seed
+        v4 = (seed - PRIME32_1) & 0xFFFFFFFF
+
+        for a, b, c, d in struct.iter_unpack("<4I", data[:n - n % 16]):
+            v1 = rotate_left((v1 + a * PRIME32_2) & 0xFFFFFFFF, 13) * PRIME32_1 & 0xFFFFFFFF
+            v2 = rotate_left((v2 + b * PRIME32_2) & 0xFFFFFFFF, 13) * PRIME32_1 & 0xFFFFFFFF
+            v3 = rotate_left((v3 + c * PRIME32_2) & 0xFFFFFFFF, 13) * PRIME32_1 & 0xFFFFFFFF
+            v4 = rotate_left((v4 + d * PRIME32_2) & 0xFFFFFFFF, 13) * PRIME32_1 & 0xFFFFFFFF
+
+        i = n - n % 16
+        h = (rotate_left(v1, 1) + rotate_left(v2, 7) + rotate_left(v3, 12) + rotate_left(v4, 18)) & 0xFFFFFFFF
+    else:
+        h = (seed + PRIME32_5) & 0xFFFFFFFF
+
+    h = (h + n) & 0xFFFFFFFF
+
+    while i + 4 <= n:
+        h = (h + struct.unpack_from("<I", data, i)[0] * PRIME32_3) & 0xFFFFFFFF
+        h = rotate_left(h, 17) * PRIME32_4 & 0xFFFFFFFF
+        i += 4
+
+    while i < n:
+        h = (h + data[i] * PRIME32_5) & 0xFFFFFFFF
+        h = rotate_left(h, 11) * PRIME32_1 & 0xFFFFFFFF
+        i += 1
+
+    h ^= h >> 15
+    h = h * PRIME32_2 & 0xFFFFFFFF
+    h ^= h >> 13
+    h = h * PRIME32_3 & 0xFFFFFFFF
+    h ^= h >> 16
+
+    return h
+
+
+def rotate_left(x, r):
+    return ((x << r) | (x >> (32 - r))) & 0xFFFFFFFF
@@ -0,0 +1,90 @@
+"""
+Library for collecting run metrics.
+"""
+
+import bisect
+import contextlib
+import json
+import time
+
+# Upper bounds of chunk compression latency histogram buckets, in seconds.
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    def to_dict(self):
+        return {"bounds": list(self.bounds),
+                "counts": self.counts,
+                "count": self.count,
+                "sum": round(self.total, 6),
+                "max": round(self.max, 6)}
+
+
+class Metrics:
+    """
+    Per-stage timings, per-region sizes and per-chunk compression latencies
+    of a run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.regions = []
+        self.chunk_latency = Histogram(LATENCY_BOUNDS)
+        self.chunk_cpu_time = 0
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        time_s = time.perf_counter()
+        cpu_s = time.process_time()
+
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {"seconds": 0, "cpu_seconds": 0})
+            stage["seconds"] += time.perf_counter() - time_s
+            stage["cpu_seconds"] += time.process_time() - cpu_s
+
+
+    def add_chunk(self, seconds, cpu_seconds):
+        self.chunk_latency.add(seconds)
+        self.chunk_cpu_time += cpu_seconds
+
+
+    def add_region(self, path, bytes_in, bytes_out, sectors_before, sectors_after, chunks):
+        self.regions.append({"path": path,
+                             "bytes_in": bytes_in,
+                             "bytes_out": bytes_out,
+                             "sectors_before": sectors_before,
+                             "sectors_after": sectors_after,
+                             "chunks": chunks})
+
+
+    def write(self, path, counters):
+        stages = {name: {key: round(value, 6) for key, value in stage.items()}
+                  for name, stage in self.stages.items()}
+
+        with open(path, "w") as f:
+            json.dump({"stages": stages,
+                       "counters": counters,
+                       "chunk_compression_latency": self.chunk_latency.to_dict(),
+                       "chunk_compression_cpu_seconds": round(self.chunk_cpu_time, 6),
+                       "regions": self.regions},
+                      f,
+                      indent=4)
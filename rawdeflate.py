@@ -0,0 +1,181 @@
+"""
+Library for building raw Deflate streams from differently compressed parts.
+
+Data which is compressed already, like chunk payloads, is put into stored
+blocks, runs of zeros are encoded as matches in fixed Huffman blocks and
+only the rest is compressed by zlib. The stream is valid Deflate, so it can
+be written into ZIP archives as is.
+"""
+
+import bisect
+import struct
+import zlib
+
+MAX_STORED_BLOCK = 65535
+
+MAX_MATCH = 258
+
+# Length codes 257-284: base lengths and extra bits.
+LENGTH_BASES = (3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31,
+                35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227)
+LENGTH_EXTRA_BITS = (0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2,
+                     3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5)
+
+END_OF_BLOCK = 256
+
+ZEROS = bytes(64 * 1024)
+
+
+def reverse_bits(value, count):
+    return int(f"{value:0{count}b}"[::-1], 2)
+
+
+def fixed_code(symbol):
+    """
+    Returns fixed Huffman code of a literal/length symbol and its length.
+    """
+    if symbol < 144:
+        return 0x30 + symbol, 8
+    elif symbol < 256:
+        return 0x190 + symbol - 144, 9
+    elif symbol < 280:
+        return symbol - 256, 7
+    else:
+        return 0xC0 + symbol - 280, 8
+
+
+# Huffman codes are packed starting from their most significant bit.
+FIXED_CODES = tuple((reverse_bits(*fixed_code(symbol)), fixed_code(symbol)[1]) for symbol in range(288))
+
+
+class DeflateWriter:
+    """
+    Raw Deflate stream, which is built in memory. CRC32 and size of the
+    uncompressed data are tracked, so the stream can become a ZIP entry.
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.bit_buffer = 0
+        self.bit_count = 0
+
+        self.crc = 0
+        self.size = 0
+
+
+    def write_bits(self, value, count):
+        self.bit_buffer |= value << self.bit_count
+        self.bit_count += count
+
+        while self.bit_count >= 8:
+            self.out.append(self.bit_buffer & 0xFF)
+            self.bit_buffer >>= 8
+            self.bit_count -= 8
+
+
+    def align(self):
+        if self.bit_count:
+            self.write_bits(0, 8 - self.bit_count)
+
+
+    def store(self, d):
+        d = memoryview(d)
+        self.crc = zlib.crc32(d, self.crc)
+        self.size += len(d)
+
+        for i in range(0, len(d), MAX_STORED_BLOCK):
+            self.write_stored_block(d[i:i + MAX_STORED_BLOCK])
+
+
+    def write_stored_block(self, d):
+        self.write_bits(0b000, 3)
+        self.align()
+
+        self.out += struct.pack("<HH", len(d), len(d) ^ 0xFFFF)
+        self.out += d
+
+
+    def compress(self, d, compression_level):
+        """
+        Appends data compressed by zlib. Matches don't reach into previous
+        parts.
+        """
+        # zlib starts at a byte boundary, an empty stored block gets there.
+        if self.bit_count:
+            self.write_stored_block(b"")
+
+        cobj = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+
+        # Sync flush ends on a byte boundary without finishing the stream.
+        self.out += cobj.compress(d)
+        self.out += cobj.flush(zlib.Z_SYNC_FLUSH)
+
+        self.crc = zlib.crc32(d, self.crc)
+        self.size += len(d)
+
+
+    def zeros(self, n):
+        """
+        Appends "n" zero bytes as a literal followed by matches of the
+        previous byte.
+        """
+        if n == 0:
+            return
+
+        for i in range(0, n, len(ZEROS)):
+            self.crc = zlib.crc32(ZEROS[:min(len(ZEROS), n - i)], self.crc)
+
+        self.size += n
+
+        # Fixed Huffman block.
+        self.write_bits(0b0, 1)
+        self.write_bits(0b01, 2)
+
+        self.write_symbol(0)
+        n -= 1
+
+        while n >= 3:
+            length = min(n, MAX_MATCH)
+
+            # Match can't leave less than 3 bytes, unless it's the last one.
+            if 0 < n - length < 3:
+                length -= 3
+
+            self.write_length(length)
+
+            # Distance 1, code 0 without extra bits.
+            self.write_bits(0, 5)
+
+            n -= length
+
+        for i in range(n):
+            self.write_symbol(0)
+
+        self.write_symbol(END_OF_BLOCK)
+
+
+    def write_length(self, length):
+        if length == MAX_MATCH:
+            self.write_symbol(285)
+            return
+
+        i = bisect.bisect_right(LENGTH_BASES, length) - 1
+
+        self.write_symbol(257 + i)
+        self.write_bits(length - LENGTH_BASES[i], LENGTH_EXTRA_BITS[i])
+
+
+    def write_symbol(self, symbol):
+        self.write_bits(*FIXED_CODES[symbol])
+
+
+    def finish(self):
+        """
+        Ends the stream with an empty final block and returns it.
+        """
+        self.write_bits(0b1, 1)
+        self.write_bits(0b01, 2)
+        self.write_symbol(END_OF_BLOCK)
+        self.align()
+
+        return bytes(self.out)
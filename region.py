@@ -2,106 +2,283 @@
 Library for reading and manipulating Region file format.
 """
 
+import array
+import mmap
+import os
 import struct
+import sys
 
 import chunk
 
 
+def check_region_file(filename):
+    """
+    Checks region file header without reading chunk data.
+
+    Returns a list of found problems. Raises HeadersErrorException if header
+    is truncated.
+    """
+    with open(filename, "rb") as f:
+        d = f.read(8192)
+        file_size = os.fstat(f.fileno()).st_size
+
+    if len(d) != 8192:
+        raise HeadersErrorException(f"Region header must contain 8192 bytes (got {len(d)}).")
+
+    offsets, sector_counts, _ = decode_header(d)
+
+    return check_locations(offsets, sector_counts, file_size)
+
+
+def read_chunk_indices(filename):
+    """
+    Returns indices of chunks with valid locations, reading only the header.
+    Raises HeadersErrorException if header is truncated.
+    """
+    with open(filename, "rb") as f:
+        d = f.read(8192)
+        file_size = os.fstat(f.fileno()).st_size
+
+    if len(d) != 8192:
+        raise HeadersErrorException(f"Region header must contain 8192 bytes (got {len(d)}).")
+
+    offsets, sector_counts, _ = decode_header(d)
+    file_sectors = -(-file_size // 4096)
+
+    return [x for x, (offset, sector_count) in enumerate(zip(offsets, sector_counts))
+            if offset != 0 and is_location_valid(offset, sector_count, file_sectors)]
+
+
+def decode_header(header):
+    """
+    Decodes region header into offsets, sector counts and timestamps arrays.
+    """
+    locations  = array.array("I")
+    timestamps = array.array("I")
+
+    locations.frombytes(header[:4096])
+    timestamps.frombytes(header[4096:8192])
+
+    if sys.byteorder == "little":
+        locations.byteswap()
+        timestamps.byteswap()
+
+    # Offset takes three upper bytes, sector count takes the lowest one.
+    offsets       = array.array("I", [location >> 8 for location in locations])
+    sector_counts = bytes(header[3:4096:4])
+
+    return offsets, sector_counts, timestamps
+
+
+def check_locations(offsets, sector_counts, file_size):
+    problems = []
+    used = []
+    file_sectors = -(-file_size // 4096)
+
+    for x, (offset, sector_count) in enumerate(zip(offsets, sector_counts)):
+        if offset == 0:
+            continue
+
+        x_loc = x % 32
+        z_loc = x // 32
+
+        if is_location_valid(offset, sector_count, file_sectors):
+            used.append((offset, sector_count, z_loc, x_loc))
+        elif sector_count == 0:
+            problems.append(f"Chunk {z_loc}; {x_loc} has zero sector count.")
+        elif offset < 2:
+            problems.append(f"Chunk {z_loc}; {x_loc} points inside region header (sector {offset}).")
+        else:
+            problems.append(f"Chunk {z_loc}; {x_loc} ends past the end of file "
+                            f"(sector {offset + sector_count}, file has {file_sectors}).")
+
+    used.sort()
+
+    for (offset, sector_count, z_loc, x_loc), (n_offset, _, n_z_loc, n_x_loc) in zip(used, used[1:]):
+        if n_offset < offset + sector_count:
+            problems.append(f"Chunk {z_loc}; {x_loc} overlaps chunk {n_z_loc}; {n_x_loc} "
+                            f"(sector {n_offset}).")
+
+    return problems
+
+
+def is_location_valid(offset, sector_count, file_sectors):
+    return sector_count != 0 and offset >= 2 and offset + sector_count <= file_sectors
+
+
+# Marks chunks which weren't read from the region file yet.
+NOT_LOADED = object()
+
+PADDING = memoryview(bytes(4096))
+
+
 class Region:
     def __init__(self):
         self.chunks = self.create_empty_region()
+        self.problems = []
+        self.mapping = None
 
     def create_empty_region(self):
-        chunks = {}
+        # Chunks are stored in the same order as in region header.
+        return [None] * 1024
 
-        for z in range(0, 32):
-            chunks[z] = {}
-            for x in range(0, 32):
-                chunks[z][x] = None
+    def read_from_file(self, filename):
+        with open(filename, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
 
-        return chunks
+            if file_size < 8192:
+                raise HeadersErrorException(f"Region header must contain 8192 bytes (got {file_size}).")
 
-    def read_from_file(self, filename):
-        f = open(filename, "rb")
-        d = f.read(8192)
+            # The map keeps its own handle, so the file can be closed right away.
+            self.read_from_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
-        if len(d) != 8192:
-            raise HeadersErrorException(f"Region header must contain 8192 bytes (got {len(d)}).")
 
-        locations  = bytearray(d[:4096])
-        timestamps = bytearray(d[4096:8192])
+    def read_from_buffer(self, buffer):
+        if len(buffer) < 8192:
+            raise HeadersErrorException(f"Region header must contain 8192 bytes (got {len(buffer)}).")
 
-        # Region file can contain up to 1,024 chunks.
-        for x in range(1024):
-            x_loc = x % 32
-            z_loc = x // 32
+        self.mapping = buffer
+        self.view = memoryview(self.mapping)
+        self.offsets, self.sector_counts, self.timestamps = decode_header(self.view[:8192])
 
-            # There's no standard 3-byte integer data type, so...
-            offset = (  int(locations[4 * x])     * 256 ** 2
-                      + int(locations[4 * x + 1]) * 256
-                      + int(locations[4 * x + 2]))
+        self.file_sectors = -(-len(buffer) // 4096)
 
-            sector_count = int(locations[4 * x + 3])
+        # Chunks with broken locations can't be read, they are reported in
+        # "problems" instead.
+        self.problems = check_locations(self.offsets, self.sector_counts, len(buffer))
 
-            if offset != 0:
-                f.seek(offset * 4096)
-                raw_data = f.read(sector_count * 4096)
+        # Chunks are created on first access.
+        self.chunks = [NOT_LOADED] * 1024
 
-                stream_length    = struct.unpack(">I", raw_data[0:4])[0]
-                compression_type = struct.unpack("B",  raw_data[4:5])[0]
 
-                nbt_data = raw_data[5:stream_length + 5]
+    def get_chunk(self, x, z):
+        index = x + z * 32
+        current_chunk = self.chunks[index]
 
-                self.chunks[z_loc][x_loc] = chunk.Chunk(x_loc,
-                                                        z_loc,
-                                                        timestamps[x * 4:x * 4 + 4],
-                                                        nbt_data,
-                                                        compression_type)
+        if current_chunk is NOT_LOADED:
+            current_chunk = self.chunks[index] = self.load_chunk(index)
 
+        return current_chunk
 
-    def compile_region_file(self):
-        result = bytearray(8192)
+
+    def set_chunk(self, x, z, current_chunk):
+        self.chunks[x + z * 32] = current_chunk
+
+
+    def load_chunk(self, index):
+        offset       = self.offsets[index]
+        sector_count = self.sector_counts[index]
+
+        if offset == 0 or not is_location_valid(offset, sector_count, self.file_sectors):
+            return None
+
+        start = offset * 4096
+        end   = start + sector_count * 4096
+
+        stream_length    = struct.unpack_from(">I", self.mapping, start)[0]
+        compression_type = self.mapping[start + 4]
+
+        # Chunk data is a view into the mapped file, nothing is copied until
+        # the chunk is recompressed. Stream length includes compression type
+        # byte.
+        nbt_data = self.view[start + 5:min(start + 4 + stream_length, end)]
+
+        return chunk.Chunk(index % 32,
+                           index // 32,
+                           self.timestamps[index],
+                           nbt_data,
+                           compression_type)
+
+
+    def close(self):
+        if self.mapping is None:
+            return
+
+        for current_chunk in self.chunks:
+            if (current_chunk is not None
+                and current_chunk is not NOT_LOADED
+                and isinstance(current_chunk.data, memoryview)):
+                current_chunk.data.release()
+
+        self.view.release()
+
+        if isinstance(self.mapping, mmap.mmap):
+            self.mapping.close()
+
+        self.mapping = None
+
+
+    def calculate_layout(self):
+        """
+        Returns present chunks with their sector offsets and sector counts in
+        region file order, and region file size in sectors.
+        """
+        layout = []
+        chunk_offset = 2
 
         for x in range(1024):
-            x_loc = x % 32
-            z_loc = x // 32
+            current_chunk = self.get_chunk(x % 32, x // 32)
+
+            if current_chunk is None:
+                continue
+
+            section_count = current_chunk.calculate_sections()
+
+            if chunk_offset >= 256 ** 3:
+                raise OverflowError(f"Chunk offset is too large. (got {chunk_offset})")
+            elif section_count > 255:
+                raise OverflowError(f"Chunk size is too large. (got {section_count} sections)")
 
-            current_chunk = self.chunks[z_loc][x_loc]
+            layout.append((x, current_chunk, chunk_offset, section_count))
+            chunk_offset += section_count
 
-            if current_chunk is not None:
-                temp = bytearray()
+        return layout, chunk_offset
 
-                section_count  = current_chunk.calculate_sections()
-                pointer_offset = self.calculate_chunk_location_offset(x_loc, z_loc)
-                chunk_offset   = len(result) // 4096
 
-                if chunk_offset >= 256 ** 3:
-                    raise OverflowError(f"Chunk offset is too large. (got {chunk_offset})")
-                elif section_count > 255:
-                    raise OverflowError(f"Chunk size is too large. (got {section_count} sections)")
-                elif pointer_offset > 256 ** 4:
-                    raise OverflowError(f"Chunk pointer is too large. (got {pointer_offset})")
+    def compile_header(self, layout):
+        header = bytearray(8192)
 
-                chunk_offset     = struct.pack(">I", chunk_offset)[1:]
-                section_count    = struct.pack("B",  section_count)
-                compression_type = struct.pack("B",  current_chunk.compression)
-                stream_length    = struct.pack(">I", len(current_chunk.data))
+        for x, current_chunk, chunk_offset, section_count in layout:
+            struct.pack_into(">I", header, 4 * x, chunk_offset << 8 | section_count)
+            struct.pack_into(">I", header, 4096 + 4 * x, current_chunk.timestamp)
 
-                temp += stream_length + compression_type
-                temp += current_chunk.data
-                temp += bytearray(4096 - ((len(current_chunk.data) + 5) % 4096))
+        return header
 
-                if len(temp) % 4096 != 0:
-                    raise AssertionError("Region file size is not divisible by 4096.")
 
-                result += temp
+    def compile_region_file(self):
+        layout, size = self.calculate_layout()
+
+        # Padding is already zeroed, only headers and chunk data are copied.
+        result = bytearray(size * 4096)
+        result[:8192] = self.compile_header(layout)
 
-                result[pointer_offset:pointer_offset + 4] = chunk_offset + section_count
-                result[pointer_offset + 4096:pointer_offset + 4096 + 4] = current_chunk.timestamp
+        for x, current_chunk, chunk_offset, section_count in layout:
+            start = chunk_offset * 4096
+
+            # Stream length includes compression type byte.
+            struct.pack_into(">IB", result, start, len(current_chunk.data) + 1, current_chunk.compression)
+            result[start + 5:start + 5 + len(current_chunk.data)] = current_chunk.data
 
         return result
 
 
+    def write_region_file(self, f):
+        """
+        Writes region file into a file object without building it in memory.
+        Returns number of written bytes.
+        """
+        layout, size = self.calculate_layout()
+
+        f.write(self.compile_header(layout))
+
+        for x, current_chunk, chunk_offset, section_count in layout:
+            f.write(struct.pack(">IB", len(current_chunk.data) + 1, current_chunk.compression))
+            f.write(current_chunk.data)
+            f.write(PADDING[:section_count * 4096 - len(current_chunk.data) - 5])
+
+        return size * 4096
+
+
     def __str__(self):
         return self.__repr__()
 
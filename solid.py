@@ -0,0 +1,352 @@
+"""
+Library for solid Anvilord archives.
+
+A solid archive is a single LZMA stream of all world files, so redundancy
+between chunks, e.g. repeated palettes, heightmaps and biomes, is exploited.
+Chunks are stored decompressed. Their compressed data is rebuilt from NBT
+when files are extracted, so only chunks which can be compressed back into
+exactly the same bytes are decompressed, all other data is stored as is.
+
+Layout:
+
+    MAGIC
+    XZ stream of file data
+    XZ stream of JSON index
+    Data stream length and index stream length, 8 bytes each, little-endian
+
+Data of a region file is its "skeleton", i.e. the file with Deflate streams
+of decompressed chunks cut out, followed by NBT of these chunks.
+
+Deflate streams are rebuilt with the zlib Anvilord runs with. Other zlib
+builds, e.g. zlib-ng, may produce different streams from the same NBT, so
+the index records zlib version and CRC32 of every stream.
+"""
+
+import json
+import lzma
+import struct
+import zlib
+
+MAGIC = b"ANVSOLID"
+VERSION = 2
+
+# Version 1 doesn't have CRC32 of chunk streams.
+SUPPORTED_VERSIONS = (1, 2)
+
+BLOCK_SIZE = 1024 ** 2
+
+# Deflate settings which chunk data is tried to be reproduced with.
+# Minecraft's default level goes first, then levels Anvilord uses.
+DEFLATE_PARAMETERS = ((6, 8, zlib.Z_DEFAULT_STRATEGY),
+                      (9, 8, zlib.Z_DEFAULT_STRATEGY),
+                      (9, 9, zlib.Z_DEFAULT_STRATEGY),
+                      (9, 9, zlib.Z_FILTERED),
+                      *((level, 8, zlib.Z_DEFAULT_STRATEGY) for level in (1, 2, 3, 4, 5, 7, 8)))
+
+
+def unpack_chunk(data, compression):
+    """
+    Returns offset and length of chunk's compressed stream inside "data",
+    chunk's NBT and Deflate settings, which reproduce the stream, or None
+    if chunk data can't be reproduced.
+
+    Uncompressed chunks have no Deflate settings.
+    """
+    if compression == 3:
+        return 0, len(data), data, None
+    elif compression == 1:
+        # Only plain headers are supported, but they are kept as is anyway.
+        if len(data) < 18 or data[:4] != b"\x1f\x8b\x08\x00":
+            return None
+
+        start = 10
+    elif compression == 2:
+        if len(data) < 6 or data[0] & 0x0F != 8 or data[1] & 0x20 or (data[0] << 8 | data[1]) % 31:
+            return None
+
+        start = 2
+    else:
+        return None
+
+    dobj = zlib.decompressobj(-15)
+
+    try:
+        nbt = dobj.decompress(data[start:])
+    except zlib.error:
+        return None
+
+    if not dobj.eof:
+        return None
+
+    length = len(data) - start - len(dobj.unused_data)
+    stream = memoryview(data)[start:start + length]
+
+    for parameters in DEFLATE_PARAMETERS:
+        if deflate_matches(nbt, stream, *parameters):
+            return start, length, nbt, parameters
+
+    return None
+
+
+def deflate_matches(data, stream, level, mem_level, strategy):
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+    i = 0
+
+    # Compressed blocks are compared as soon as they're ready, so most
+    # mismatches are found without compressing everything.
+    for j in range(0, len(data), BLOCK_SIZE // 16):
+        d = cobj.compress(data[j:j + BLOCK_SIZE // 16])
+
+        if stream[i:i + len(d)] != d:
+            return False
+
+        i += len(d)
+
+    d = cobj.flush()
+
+    return len(stream) == i + len(d) and stream[i:] == d
+
+
+def pack_chunk(nbt, parameters):
+    if parameters is None:
+        return nbt
+
+    level, mem_level, strategy = parameters
+    cobj = zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+
+    return cobj.compress(nbt) + cobj.flush()
+
+
+def is_solid_archive(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class SolidWriter:
+    def __init__(self, path, preset=9):
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+
+        self.compressor = lzma.LZMACompressor(lzma.FORMAT_XZ, preset=preset)
+        self.entries = []
+        self.source_size = 0
+        self.data_size = 0
+
+
+    def write(self, d):
+        self.data_size += self.f.write(self.compressor.compress(d))
+
+
+    def add_file(self, name, f, mtime_ns=None):
+        entry = {"path": name, "size": 0, "crc32": 0}
+
+        while d := f.read(BLOCK_SIZE):
+            entry["size"] += len(d)
+            entry["crc32"] = zlib.crc32(d, entry["crc32"])
+            self.write(d)
+
+        self.add_entry(entry, mtime_ns)
+
+
+    def add_region(self, name, data, chunks, mtime_ns=None):
+        """
+        Stores region file "data", where "chunks" are results of
+        unpack_chunk() with absolute offsets of compressed streams.
+        """
+        data = memoryview(data)
+        chunks = sorted(chunks, key=lambda c: c[0])
+
+        entry = {"path": name,
+                 "size": len(data),
+                 "crc32": zlib.crc32(data),
+                 "chunks": [[offset, length, len(nbt), parameters, zlib.crc32(data[offset:offset + length])]
+                            for offset, length, nbt, parameters in chunks]}
+
+        i = 0
+
+        for offset, length, nbt, parameters in chunks:
+            self.write(data[i:offset])
+            i = offset + length
+
+        self.write(data[i:])
+
+        for offset, length, nbt, parameters in chunks:
+            self.write(nbt)
+
+        self.add_entry(entry, mtime_ns)
+
+
+    def add_entry(self, entry, mtime_ns):
+        if mtime_ns is not None:
+            entry["mtime_ns"] = mtime_ns
+
+        self.source_size += entry["size"]
+        self.entries.append(entry)
+
+
+    def close(self):
+        self.data_size += self.f.write(self.compressor.flush())
+
+        index = json.dumps({"version": VERSION,
+                            "zlib_version": zlib.ZLIB_RUNTIME_VERSION,
+                            "entries": self.entries},
+                           separators=(",", ":")).encode()
+        index = lzma.compress(index, lzma.FORMAT_XZ)
+
+        self.f.write(index)
+        self.f.write(struct.pack("<QQ", self.data_size, len(index)))
+        self.f.close()
+
+
+class SolidReader:
+    def __init__(self, path):
+        self.f = open(path, "rb")
+
+        if self.f.read(len(MAGIC)) != MAGIC:
+            self.f.close()
+            raise ValueError(f'"{path}" is not a solid Anvilord archive.')
+
+        self.f.seek(-16, 2)
+        self.data_size, index_size = struct.unpack("<QQ", self.f.read(16))
+
+        self.f.seek(len(MAGIC) + self.data_size)
+        index = json.loads(lzma.decompress(self.f.read(index_size)))
+
+        if index["version"] not in SUPPORTED_VERSIONS:
+            self.f.close()
+            raise ValueError(f'"{path}" has unsupported version {index["version"]}.')
+
+        self.entries = index["entries"]
+        self.zlib_version = index.get("zlib_version")
+
+
+    def zlib_matches(self):
+        return self.zlib_version == zlib.ZLIB_RUNTIME_VERSION
+
+
+    def read_entries(self, is_wanted=None):
+        """
+        Yields wanted entries with their stored data, in archive order. Data
+        of other entries is only decompressed and dropped. unpack_entry()
+        turns stored data into the file.
+        """
+        self.f.seek(len(MAGIC))
+        stream = StreamReader(self.f, self.data_size)
+
+        for entry in self.entries:
+            if is_wanted is None or is_wanted(entry):
+                yield entry, stream.read(stored_size(entry))
+            else:
+                stream.skip(stored_size(entry))
+
+
+    def close(self):
+        self.f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def stored_size(entry):
+    chunks = entry.get("chunks", ())
+
+    return entry["size"] - sum(chunk[1] for chunk in chunks) + sum(chunk[2] for chunk in chunks)
+
+
+def unpack_entry(entry, d):
+    """
+    Returns file data of an entry from its stored data. Raises RebuildError
+    if a region file can't be rebuilt.
+    """
+    if "chunks" in entry:
+        d = rebuild_region(entry, d)
+
+    if zlib.crc32(d) != entry["crc32"]:
+        raise ValueError(f'"{entry["path"]}" is corrupted: CRC mismatch.')
+
+    return d
+
+
+def rebuild_region(entry, d):
+    """
+    Returns region file data from its skeleton followed by NBT of its
+    chunks.
+    """
+    chunks = entry["chunks"]
+    d = memoryview(d)
+    skeleton = d[:entry["size"] - sum(chunk[1] for chunk in chunks)]
+    k = len(skeleton)
+
+    result = bytearray()
+    i = 0
+    mismatches = 0
+
+    for offset, length, nbt_length, parameters, *crc in chunks:
+        # Offsets point into the original file, not into the skeleton.
+        j = offset - len(result) + i
+        result += skeleton[i:j]
+        i = j
+
+        compressed = pack_chunk(d[k:k + nbt_length], parameters)
+        k += nbt_length
+
+        if len(compressed) != length or (crc and zlib.crc32(compressed) != crc[0]):
+            mismatches += 1
+
+            # Following offsets are counted from the original length.
+            compressed = compressed[:length].ljust(length, b"\0")
+
+        result += compressed
+
+    result += skeleton[i:]
+
+    if mismatches:
+        raise RebuildError(f'"{entry["path"]}" can\'t be rebuilt: {mismatches} chunks differ.')
+
+    return bytes(result)
+
+
+class RebuildError(ValueError):
+    pass
+
+
+class StreamReader:
+    """
+    Reads decompressed data of an XZ stream, which is "size" bytes long.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+        self.decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+
+    def read(self, n):
+        result = bytearray()
+
+        while len(result) < n:
+            d = b""
+
+            if self.decompressor.eof:
+                raise EOFError("Data stream is truncated.")
+
+            if self.decompressor.needs_input:
+                if self.remaining == 0:
+                    raise EOFError("Data stream is truncated.")
+
+                d = self.f.read(min(BLOCK_SIZE, self.remaining))
+                self.remaining -= len(d)
+
+            result += self.decompressor.decompress(d, n - len(result))
+
+        return bytes(result)
+
+
+    def skip(self, n):
+        while n > 0:
+            n -= len(self.read(min(n, BLOCK_SIZE)))
@@ -0,0 +1,129 @@
+"""
+Library for spreading a wall-clock time budget over chunk recompression.
+"""
+
+import collections
+import threading
+import time
+
+# Costs assumed until the first chunks finish, in CPU-seconds per sector of
+# source data. Zopfli costs are per iteration.
+ZOPFLI_COST_GUESS = 0.005
+ZLIB_COST_GUESS = 0.0005
+
+# Chunks of a size class get between a quarter and four times iterations
+# of an average chunk, depending on sections they save per CPU-second.
+MIN_WEIGHT = 0.25
+MAX_WEIGHT = 4
+
+# Gains of a size class are trusted after this many chunks.
+MIN_OBSERVATIONS = 8
+
+
+class TimeBudget:
+    """
+    Chooses Zopfli iterations of every chunk, so recompression finishes
+    before "deadline". Costs and gains are learned from finished chunks.
+    Zero iterations mean zlib level 9, which is what chunks get when the
+    budget runs low.
+    """
+
+    def __init__(self, deadline, jobs, sectors, max_iterations):
+        self.deadline = deadline
+        self.jobs = jobs
+        self.max_iterations = max_iterations
+        self.lock = threading.Lock()
+
+        # Sectors of regions not started yet and of the current one.
+        self.remaining_sectors = sectors
+        self.region_sectors = 0
+
+        # Estimated CPU-seconds of submitted chunks which didn't finish.
+        self.pending_cost = 0
+
+        self.zopfli_seconds = 0
+        self.zopfli_work = 0
+        self.zlib_seconds = 0
+        self.zlib_work = 0
+
+        # Size class: [chunks, sections saved, CPU-seconds].
+        self.gains = collections.defaultdict(lambda: [0, 0, 0])
+
+
+    def start_region(self, sectors):
+        with self.lock:
+            self.remaining_sectors = max(0, self.remaining_sectors - sectors)
+            self.region_sectors = sectors
+
+
+    def choose(self, sections):
+        """
+        Returns Zopfli iterations for a chunk of "sections" sectors and its
+        estimated cost, which must be passed to finish().
+        """
+        with self.lock:
+            self.region_sectors = max(0, self.region_sectors - sections)
+            left = self.remaining_sectors + self.region_sectors + sections
+
+            zopfli_cost = unit_cost(self.zopfli_seconds, self.zopfli_work, ZOPFLI_COST_GUESS)
+            zlib_cost = unit_cost(self.zlib_seconds, self.zlib_work, ZLIB_COST_GUESS)
+
+            available = max(0, self.deadline - time.monotonic()) * self.jobs - self.pending_cost
+
+            # Everything left must fit in the budget with zlib at least.
+            spare = available - zlib_cost * left
+            iterations = 0
+
+            if spare > 0:
+                # Zopfli costs roughly an iteration more than it's told to.
+                average = spare / (zopfli_cost * left) - 1
+                iterations = min(int(average * self.weight(sections)), self.max_iterations)
+
+            if iterations < 1:
+                cost = zlib_cost * sections
+                iterations = 0
+            else:
+                cost = zopfli_cost * sections * (iterations + 1)
+
+            self.pending_cost += cost
+
+            return iterations, cost
+
+
+    def finish(self, cost, sections, iterations, saved_sections=None, cpu_seconds=None):
+        """
+        Records a finished chunk. Failed chunks have no results.
+        """
+        with self.lock:
+            self.pending_cost = max(0, self.pending_cost - cost)
+
+            if cpu_seconds is None:
+                return
+
+            if iterations == 0:
+                self.zlib_seconds += cpu_seconds
+                self.zlib_work += sections
+                return
+
+            self.zopfli_seconds += cpu_seconds
+            self.zopfli_work += sections * (iterations + 1)
+
+            gain = self.gains[sections.bit_length()]
+            gain[0] += 1
+            gain[1] += saved_sections
+            gain[2] += cpu_seconds
+
+
+    def weight(self, sections):
+        chunks, saved, seconds = self.gains.get(sections.bit_length(), (0, 0, 0))
+        total_saved = sum(gain[1] for gain in self.gains.values())
+        total_seconds = sum(gain[2] for gain in self.gains.values())
+
+        if chunks < MIN_OBSERVATIONS or seconds == 0 or total_saved == 0:
+            return 1
+
+        return min(max((saved / seconds) / (total_saved / total_seconds), MIN_WEIGHT), MAX_WEIGHT)
+
+
+def unit_cost(seconds, work, guess):
+    return seconds / work if work else guess
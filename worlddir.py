@@ -0,0 +1,136 @@
+"""
+Library for writing world files directly into a folder.
+
+Every file is written into a temporary file next to its destination first and
+renamed over it when complete, so a crash never leaves a half-written file
+behind. That makes it safe to write into the source world itself.
+"""
+
+import errno
+import functools
+import os
+import shutil
+import tempfile
+
+# Errors which mean that the fast copy path isn't available for these files.
+FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+class AtomicFile:
+    """
+    Writable file, which replaces "dest" when it is closed without errors.
+
+    Permissions, and times unless "preserve_times" is false, are copied from
+    "source" if it's given. Otherwise the file gets "mode", or permissions of
+    a newly created file, limited by umask.
+    """
+
+    def __init__(self, dest, source=None, preserve_times=True, mode=None):
+        self.dest = dest
+        self.source = source
+        self.preserve_times = preserve_times
+        self.mode = 0o666 if mode is None else mode
+
+        folder, name = os.path.split(dest)
+        os.makedirs(folder or ".", exist_ok=True)
+
+        fd, self.temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=folder or ".")
+        self.f = os.fdopen(fd, "wb")
+
+
+    def __enter__(self):
+        return self.f
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.f.close()
+            os.unlink(self.temp_path)
+            return
+
+        try:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+
+            if self.source is not None:
+                if self.preserve_times:
+                    shutil.copystat(self.source, self.temp_path)
+                else:
+                    shutil.copymode(self.source, self.temp_path)
+            else:
+                # Temporary files are readable by their owner only.
+                os.chmod(self.temp_path, self.mode & ~get_umask())
+
+            os.replace(self.temp_path, self.dest)
+        except BaseException:
+            self.f.close()
+            os.unlink(self.temp_path)
+            raise
+
+
+@functools.lru_cache(maxsize=None)
+def get_umask():
+    # Umask can only be read by setting it.
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return umask
+
+
+def is_same_file(source, dest):
+    return os.path.exists(dest) and os.path.samefile(source, dest)
+
+
+def copy_file(source, dest, preserve_times=True):
+    """
+    Copies file as is, inside the kernel where possible. Nothing is done
+    when "dest" is "source" itself.
+    """
+    if is_same_file(source, dest):
+        return
+
+    with open(source, "rb") as src, AtomicFile(dest, source, preserve_times) as dst:
+        copy_file_data(src, dst)
+
+
+def copy_file_data(src, dst):
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+
+    # copy_file_range() may even share data blocks on copy-on-write file
+    # systems, sendfile() at least doesn't copy data through user space.
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                n = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+
+                if n == 0:
+                    break
+
+                offset += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+
+    # copy_file_range() doesn't move file positions.
+    dst.seek(offset)
+
+    if hasattr(os, "sendfile") and offset < size:
+        try:
+            while offset < size:
+                n = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+
+                if n == 0:
+                    break
+
+                offset += n
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+
+            dst.seek(offset)
+
+    # File might have grown since, the rest is copied in user space.
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, 1024 ** 2)
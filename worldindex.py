@@ -0,0 +1,65 @@
+"""
+Library for indexing world files.
+"""
+
+import os
+
+# Region files are kept in folders, which names end with these.
+REGION_FOLDERS = ("region", "entities", "poi")
+
+REGION_EXTENSIONS = (".mca", ".mcr")
+
+
+class WorldFile:
+    __slots__ = ("path", "kind", "size", "mtime_ns", "dimension")
+
+    def __init__(self, path, kind, size, mtime_ns, dimension=None):
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.dimension = dimension
+
+
+    @property
+    def mtime(self):
+        return self.mtime_ns / 1e9
+
+
+def scan_world(path):
+    """
+    Walks the world once and returns its files in name order. Region files
+    have "region" kind and know their dimension, all other files have
+    "file" kind.
+    """
+    files = []
+    scan_folder(path, path, False, files)
+
+    return files
+
+
+def scan_folder(world, path, is_region_folder, files):
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+
+    for entry in entries:
+        temp_path = path + "/" + entry.name
+
+        if entry.is_dir():
+            scan_folder(world, temp_path, entry.name.endswith(REGION_FOLDERS), files)
+            continue
+
+        st = entry.stat()
+
+        # Backups and temporary files lying next to region files aren't
+        # regions.
+        if is_region_folder and entry.name.endswith(REGION_EXTENSIONS):
+            files.append(WorldFile(temp_path, "region", st.st_size, st.st_mtime_ns, get_dimension(world, path)))
+        else:
+            files.append(WorldFile(temp_path, "file", st.st_size, st.st_mtime_ns))
+
+
+def get_dimension(world, region_folder):
+    dimension = os.path.relpath(os.path.dirname(region_folder), world).replace(os.sep, "/")
+
+    return "overworld" if dimension == "." else dimension